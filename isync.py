@@ -32,12 +32,32 @@ else:
 # --------------------------------
 APP_DESCRIPTION = _i('A simple synchronizer between iTunes and Walkman')
 DEFAULT_CONFIG_FILENAME = 'iSyncConfig.json'
+LIBRARY_CACHE_FILENAME = 'iSyncLibrary.cache'
+MANIFEST_FILENAME = '.isync_manifest.json'
+FINGERPRINT_CACHE_FILENAME = 'iSyncFingerprints.json'
+MEDIA_INDEX_FILENAME = 'iSyncMediaIndex.json'
+DAEMON_SOCKET_FILENAME = '.isync.sock'
+PROFILE_DIRNAME = 'isync-profile'
 SYSTEM_PLAYLISTS = set(['Libaray', 'ライブラリ'])
 DEBUG_MODE = False
 MUSICFILE_EXTENSIONS = ['mp3', 'm4a', 'm4p']
+PLAYLIST_EXTENSION = '.m3u8'
+LAYOUT_DIRECTORIES = 'directories'  # A directory for each playlist
+LAYOUT_POOL = 'pool'  # Shared tracks and M3U playlists
+LAYOUTS = (LAYOUT_DIRECTORIES, LAYOUT_POOL)
+FSYNC_NONE = 'none'
+FSYNC_PLAYLIST = 'playlist'  # Make copies durable at playlist boundaries
+FSYNC_FILE = 'file'
+FSYNC_POLICIES = (FSYNC_NONE, FSYNC_PLAYLIST, FSYNC_FILE)
+COPY_ORDER_PLAYLIST = 'playlist'
+COPY_ORDER_LOCALITY = 'locality'  # Sorted by where sources are on disk
+COPY_ORDERS = (COPY_ORDER_PLAYLIST, COPY_ORDER_LOCALITY)
+PLANNING_JOBS = 8  # Playlists planned at once, mostly waiting for stat
+VERIFY_FULL = 'full'
+VERIFY_SAMPLE = 'sample'  # Random VERIFY_SAMPLE_RATIO of files
+VERIFY_SAMPLE_RATIO = 0.1
 
 # Import list
-import plistlib
 import sys
 import os
 import platform
@@ -48,7 +68,6 @@ import datetime
 import re
 import string
 import logging
-import math
 import json
 import concurrent.futures
 import queue
@@ -56,11 +75,31 @@ import inspect
 import argparse
 import threading
 import unicodedata
+import asyncio
+import socket
+import socketserver
+import base64
+import io
+import functools
+import errno
+import bisect
+import collections
+import contextlib
+import heapq
+import time
+import hashlib
+import pickle
+import random
+import weakref
+import cProfile
+import pstats
+import tracemalloc
+import xml.etree.ElementTree as ElementTree
 from logging import error, warn, info, debug
 
 # Version check
-if sys.version < '3.3':
-    raise _i('Python 3.3 or above required.')
+if sys.version_info < (3, 5):
+    raise RuntimeError(_i('Python 3.5 or above required.'))
 
 FILEDIR = os.path.abspath(os.path.dirname(__file__))
 
@@ -83,8 +122,8 @@ def cached_property(f):
 #  Main class
 # --------------------------------
 class Main:
-    def __init__(self):
-        self.args = CommandArguments()
+    def __init__(self, args=None):
+        self.args = CommandArguments(args)
         self._init_logger()
 
     def start(self):
@@ -96,7 +135,16 @@ class Main:
         try:
             # Check config file
             self.config
-            self.sync()
+            if self.args.apply:
+                self.apply_plan()
+            elif self.args.daemon:
+                self.serve()
+            elif self.args.trigger:
+                self.trigger()
+            elif self.args.set_limits:
+                self.set_limits()
+            else:
+                self.sync()
         except FileNotFoundError as e:
             Config.prepare_default(self.library)
             warn(_i("Unable to read configuration, creating new one."))
@@ -104,41 +152,178 @@ class Main:
                  .format(self.args.config or DEFAULT_CONFIG_FILENAME))
 
 
-    def create_syncer(self):
-        if self.config.is_dry:
+    def create_syncer(self, config=None):
+        config = config or self.config
+        if getattr(config, 'plan_out', None):
+            return PlanningSyncer
+        if config.is_dry:
             info("Dry-run mode.")
             return DryLibrarySyncer
         else:
             return LibrarySyncer
 
     def sync(self):
-        syncerClass = self.create_syncer()
-        syncer = syncerClass(
-            self.library,
-            self.config,
-            self.device)
-        syncer.start()
+        if self.config.all_devices:
+            if self.config.plan_out:
+                self.abort(_i("--plan-out saves a plan of one device, \
+it cannot be used with --all-devices."))
+            return self.sync_all()
+        report = SyncReport()
+        report.profiler = self.profiler
+        with report.phase('library', profile=True):
+            library = self.library
+        with report.phase('devices', profile=True):
+            device = self.device
+        self.run_syncer(library, device, report)
+        self.print_report(report)
+
+    def sync_all(self):
+        """Sync to every device found, reading each source once"""
+        report = SyncReport()  # Only for profiling
+        report.profiler = self.profiler
+        if self.profiler is not None:
+            warn(_i("Only loading the library and searching devices are \
+profiled with --all-devices."))
+        with report.phase('library', profile=True):
+            library = self.library
+        with report.phase('devices', profile=True):
+            devices = self.find_devices()
+        if not devices:
+            self.abort(_i("No suitable device found."))
+        fingerprints = FingerprintCache.load(
+            self.config.cache_path(FINGERPRINT_CACHE_FILENAME),
+            self.config.use_fingerprint_hash)
+        syncers = [self.create_library_syncer(library, device, SyncReport(),
+                                              fingerprints=fingerprints)
+                   for device in devices]
+        for device in devices:
+            info(_i("I will use {} for syncing").format(device.root_dir))
+        self.print_report(*MultiDeviceSyncer(syncers).sync())
+
+    def apply_plan(self):
+        """Run a plan saved by --plan-out"""
+        plan = SyncPlanFile.load(self.args.apply)
+        conflicts = plan.conflicts()
+        if conflicts:
+            for conflict in conflicts:
+                error(conflict)
+            self.abort(_i("The plan is outdated, please plan again."))
+        self.print_report(plan.apply(self.create_executor()))
+
+    def create_executor(self, config=None):
+        config = config or self.config
+        executorClass = EXECUTOR_ENGINES[config.engine]
+        copy_order = getattr(config, 'copy_order', COPY_ORDER_PLAYLIST)
+        return executorClass(max_workers=config.jobs,
+                             locality=copy_order == COPY_ORDER_LOCALITY)
+
+    def run_syncer(self, library, device, report, config=None,
+                   fingerprints=None, rate_limits=None):  # -> SyncReport
+        return self.create_library_syncer(
+            library, device, report, config, fingerprints,
+            rate_limits).start()
+
+    def create_library_syncer(self, library, device, report, config=None,
+                              fingerprints=None, rate_limits=None):
+        """LibrarySyncer with an executor of its own"""
+        config = config or self.config
+        syncerClass = self.create_syncer(config)
+        ExecutorService.root.default = self.create_executor(config)
+        progress = None
+        if getattr(config, 'progress', False):
+            progress = ProgressBus()
+            progress.subscribe(log_progress)
+        return syncerClass(
+            library,
+            config,
+            device,
+            report,
+            fingerprints=fingerprints,
+            progress=progress,
+            rate_limits=rate_limits)
 
     @property
+    def daemon_socket_path(self):
+        return self.config.cache_path(DAEMON_SOCKET_FILENAME)
+
+    def serve(self):
+        if not hasattr(socket, 'AF_UNIX'):
+            self.abort(_i("Daemon mode is not supported on this platform."))
+        SyncDaemon(self, self.daemon_socket_path).serve_forever()
+
+    def trigger(self):
+        try:
+            ok = SyncDaemon.request(self.daemon_socket_path, 'sync')
+        except OSError as e:
+            self.abort(_i("isync daemon is not running: {}").format(e))
+        if not ok:
+            sys.exit(1)
+
+    def set_limits(self):
+        """Change rate limits of the resident daemon, even while syncing"""
+        try:
+            RateLimits.parse(self.args.set_limits)
+            ok = SyncDaemon.request(
+                self.daemon_socket_path,
+                ' '.join(['limit'] + self.args.set_limits))
+        except ValueError as e:
+            self.abort(e)
+        except OSError as e:
+            self.abort(_i("isync daemon is not running: {}").format(e))
+        if not ok:
+            sys.exit(1)
+
+    def print_report(self, *reports):
+        if self.args.stats:
+            for report in reports:
+                print(report.format())
+        if self.args.stats_json:
+            dics = [report.to_dict() for report in reports]
+            with open(self.args.stats_json, 'w') as f:
+                json.dump(dics[0] if len(dics) == 1 else dics, f, indent=4)
+
+    @cached_property
+    def profiler(self):  # -> PhaseProfiler or None
+        cpu_dir = getattr(self.args, 'profile', None)
+        memory_dir = getattr(self.args, 'profile_memory', None)
+        if not cpu_dir and not memory_dir:
+            return None
+        return PhaseProfiler(cpu_dir or memory_dir, cpu=bool(cpu_dir),
+                             memory=bool(memory_dir))
+
+    @cached_property
     def env(self):
-        return EnvironmentBuilder.create()
+        env = EnvironmentBuilder.create()
+        try:
+            env.media_index_path = \
+                self.config.cache_path(MEDIA_INDEX_FILENAME)
+        except FileNotFoundError:  # No configuration yet
+            pass
+        return env
 
     @cached_property
     def config(self):
         info(_i("Reading configurations..."))
         try:
-            path = self.args.config
-            cfg = Config.load(self.args, path)
-            cfg.logging_level = self._logging_level # set logging level
-            return cfg
+            return self.load_config()
+        except ValueError as e:  # Invalid JSON or values
+            self.abort(e)
         except Exception as e:
             warn(e)
             raise e
 
+    def load_config(self):
+        cfg = Config.load(self.args, self.args.config)
+        cfg.logging_level = self._logging_level # set logging level
+        return cfg
+
+    def find_devices(self):  # -> list<Device>
+        return list(DeviceLocator(self.env, self.config).find_all())
+
     @cached_property
     def device(self):
         info(_i("Searching device..."))
-        devices = list(DeviceLocator(self.env, self.config).find_all())
+        devices = self.find_devices()
         if len(devices) < 1:
             self.abort(_i("No suitable device found."))
         elif len(devices) > 1 and\
@@ -151,11 +336,25 @@ syncing.").format(devices[0]))
     @cached_property
     def library(self):
         try:
-            return Library(self.env.itunes_libfile())
+            return self.load_library()
         except Exception as e:
             error(e)
             self.abort(_i("No iTunes library found."))
 
+    def load_library(self):
+        return Library(self.env.itunes_libfile(), self.env,
+                       cache=self.library_cache)
+
+    @cached_property
+    def library_cache(self):
+        try:
+            if not self.config.use_library_cache:
+                return None
+            return LibraryCache(
+                self.config.cache_path(LIBRARY_CACHE_FILENAME))
+        except FileNotFoundError:  # No configuration yet
+            return None
+
     # DO NOT refer any attributes except 'args' to make sense of
     # logging.basicConfig
     def _init_logger(self):
@@ -174,6 +373,203 @@ syncing.").format(devices[0]))
         sys.exit(-1)
 
 
+class SyncDaemon:
+    """Resident process which keeps the library and caches in memory.
+
+    Clients send a command line ('sync', 'stop' or 'limit KIND=RATE...')
+    to a Unix socket, and receive log messages of the sync followed by a
+    status line.  Requests are handled on threads of their own, so that
+    limits can be changed during a sync.  The
+    config, the library file and the device are polled, and changes are
+    loaded and synced without waiting for a client.
+
+    A client receives messages logged while its sync runs, except those
+    of the watcher and of other requests.
+    """
+    POLL_INTERVAL = 5  # seconds
+    STATUS_OK = 'OK'
+    STATUS_FAILED = 'FAILED'
+
+    def __init__(self, main, socket_path, poll_interval=POLL_INTERVAL):
+        self.main = main
+        self.socket_path = socket_path
+        self.poll_interval = poll_interval
+        self.config = main.config
+        self.library = None
+        self.device = None
+        self._mtimes = {}  # path -> mtime_ns
+        self._changed(self.config.path)
+        self._lock = threading.RLock()  # a sync or a reload at once
+        self._stopped = threading.Event()
+        self._server = None
+        self._threads = set()  # idents of the watcher and request handlers
+        self.rate_limits = RateLimits()  # Kept over syncs
+
+    @cached_property
+    def fingerprints(self):
+        return FingerprintCache.load(
+            self.config.cache_path(FINGERPRINT_CACHE_FILENAME),
+            self.config.use_fingerprint_hash)
+
+    def _changed(self, path):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except (OSError, TypeError):
+            mtime = None
+        changed = self._mtimes.get(path, -1) != mtime
+        self._mtimes[path] = mtime
+        return changed
+
+    def refresh(self):  # -> bool
+        """Reload changed files and find the device again if it is
+        unmounted.  Returns True if the library or the device changed."""
+        with self._lock:
+            changed = False
+            if self._changed(self.config.path):
+                info(_i("Reloading configurations..."))
+                try:
+                    self.config = self.main.load_config()
+                except ValueError as e:
+                    error(_i("Configurations are not reloaded: {}")
+                          .format(e))
+            if self._changed(self.main.env.itunes_libfile()):
+                info(_i("Loading iTunes library..."))
+                self.library = self.main.load_library()
+                changed = True
+            if self.device is None or \
+                    not os.path.isdir(self.device.root_dir):
+                devices = self.main.find_devices()
+                self.device = devices[0] if devices else None
+                changed = changed or self.device is not None
+            return changed
+
+    def sync(self):  # -> SyncReport
+        with self._lock:
+            self.refresh()
+            if self.library is None:
+                raise RuntimeError(_i("No iTunes library found."))
+            if self.device is None:
+                raise RuntimeError(_i("No suitable device found."))
+            return self.main.run_syncer(self.library, self.device,
+                                        SyncReport(), self.config,
+                                        self.fingerprints, self.rate_limits)
+
+    def watch(self):
+        self._threads.add(threading.get_ident())
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                with self._lock:
+                    if self.refresh() and self.device is not None:
+                        info(_i("Changes are detected, syncing."))
+                        self.sync()
+            except Exception as e:
+                error(e)
+
+    def handle(self, rfile, wfile):
+        ident = threading.get_ident()
+        self._threads.add(ident)
+        try:
+            status = self._handle(rfile.readline().decode('utf-8').strip(),
+                                  wfile)
+        finally:
+            self._threads.discard(ident)
+        wfile.write((status + '\n').encode('utf-8'))
+
+    def _handle(self, command, wfile):  # -> status
+        status = self.STATUS_OK
+        if command == 'sync':
+            ident = threading.get_ident()
+            handler = SocketLogHandler(wfile)
+            # Other threads which log are workers of this sync
+            handler.addFilter(lambda record: record.thread == ident or
+                              record.thread not in self._threads)
+            with self._lock:  # Attached only while this sync runs
+                logging.getLogger().addHandler(handler)
+                try:
+                    self.sync()
+                except Exception as e:
+                    error(e)
+                    status = self.STATUS_FAILED
+                finally:
+                    logging.getLogger().removeHandler(handler)
+        elif command == 'stop':
+            threading.Thread(target=self._server.shutdown).start()
+        elif command.startswith('limit '):
+            try:
+                self.rate_limits.override(
+                    **RateLimits.parse(command.split()[1:]))
+                info(_i("Rate limits are changed: {}").format(command[6:]))
+            except ValueError as e:
+                error(e)
+                status = self.STATUS_FAILED
+        elif command != 'ping':
+            status = self.STATUS_FAILED
+        return status
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            try:
+                SyncDaemon.request(self.socket_path, 'ping', output=None)
+                raise RuntimeError(_i("isync daemon is already running."))
+            except ConnectionRefusedError:
+                os.unlink(self.socket_path)  # left by a killed daemon
+        self.refresh()
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                daemon.handle(self.rfile, self.wfile)
+
+        self._server = socketserver.ThreadingUnixStreamServer(
+            self.socket_path, Handler)
+        self._server.daemon_threads = True
+        watcher = threading.Thread(target=self.watch, daemon=True)
+        watcher.start()
+        info(_i("Waiting for requests at {}").format(self.socket_path))
+        try:
+            self._server.serve_forever()
+        finally:
+            self._stopped.set()
+            self._server.server_close()
+            os.unlink(self.socket_path)
+            watcher.join()
+
+    @staticmethod
+    def request(socket_path, command, output=sys.stdout):  # -> bool
+        """Send command to a daemon and print its messages"""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            sock.sendall((command + '\n').encode('utf-8'))
+            status = None
+            for line in sock.makefile('rb'):
+                if status is not None and output is not None:
+                    print(status, file=output)
+                status = line.decode('utf-8').rstrip('\n')
+            return status == SyncDaemon.STATUS_OK
+
+
+class SocketLogHandler(logging.Handler):
+    def __init__(self, wfile):
+        super().__init__()
+        self.wfile = wfile
+        self.setFormatter(logging.Formatter('%(levelname)-5s %(message)s'))
+
+    def emit(self, record):
+        try:
+            self.wfile.write((self.format(record) + '\n').encode('utf-8'))
+        except OSError:
+            pass  # Client has gone
+
+
+def positive_rate(value):  # -> float
+    """argparse type of rate limits"""
+    try:
+        return RateLimits.check('read', value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            _i("{} is not a positive rate").format(value))
+
+
 # DO NOT use logging functions
 class CommandArguments:
     def __init__(self, args=None):
@@ -188,6 +584,70 @@ class CommandArguments:
 Set logging level to DEBUG'))
         parser.add_argument('-t', '--target', metavar='DIR',
                             nargs='?', help='Sync target directory')
+        parser.add_argument('--layout',
+                            choices=LAYOUTS,
+                            help=_i('How playlists are stored on the device'))
+        parser.add_argument('--stats', action='store_true',
+                            help=_i('Print timings and throughput of the \
+sync'))
+        parser.add_argument('--verify', nargs='?', const=VERIFY_FULL,
+                            choices=[VERIFY_FULL, VERIFY_SAMPLE],
+                            help=_i('Compare files on the device with their \
+sources after syncing, and copy differing ones again'))
+        parser.add_argument('--progress', action='store_true',
+                            help=_i('Log progress and remaining time of \
+copies'))
+        parser.add_argument('--profile', metavar='DIR', nargs='?',
+                            const=PROFILE_DIRNAME,
+                            help=_i('Write cProfile stats of each phase into \
+DIR'))
+        parser.add_argument('--profile-memory', metavar='DIR', nargs='?',
+                            const=PROFILE_DIRNAME,
+                            help=_i('Write top memory allocations of each \
+phase into DIR'))
+        parser.add_argument('--stats-json', metavar='PATH',
+                            help=_i('Write timings and throughput of the \
+sync as JSON'))
+        parser.add_argument('--plan-out', metavar='PATH',
+                            help=_i('Save actions of the sync to PATH \
+instead of running them'))
+        parser.add_argument('--apply', metavar='PATH',
+                            help=_i('Run actions saved by --plan-out'))
+        parser.add_argument('--all-devices', action='store_true',
+                            help=_i('Sync every device found, instead of \
+the first one'))
+        parser.add_argument('--rescan', action='store_true',
+                            help=_i('Ignore the sync manifest on the device \
+and scan its directories again'))
+        parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                            help=_i('Number of files transferred at once'))
+        parser.add_argument('--copy-order',
+                            choices=COPY_ORDERS,
+                            help=_i('Order of copies, locality reads sources \
+in their order on disk'))
+        parser.add_argument('--read-ahead', metavar='MIB', type=int,
+                            help=_i('Read sources of next copies into up to \
+MIB of memory while writing to the device'))
+        parser.add_argument('--engine', choices=sorted(EXECUTOR_ENGINES),
+                            help=_i('How file operations are executed'))
+        parser.add_argument('--daemon', action='store_true',
+                            help=_i('Stay resident and sync on requests \
+or changes'))
+        parser.add_argument('--trigger', action='store_true',
+                            help=_i('Ask the resident daemon to sync'))
+        parser.add_argument('--set-limits', metavar='KIND=RATE', nargs='+',
+                            help=_i('Change rate limits of the resident \
+daemon, e.g. write=5 ops=off'))
+        parser.add_argument('--limit-read', metavar='MBPS',
+                            type=positive_rate,
+                            help=_i('Limit reading sources to MBPS MB/s'))
+        parser.add_argument('--limit-write', metavar='MBPS',
+                            type=positive_rate,
+                            help=_i('Limit writing to the device to MBPS \
+MB/s'))
+        parser.add_argument('--limit-ops', metavar='N', type=positive_rate,
+                            help=_i('Limit other file operations to N per \
+second'))
         parser.add_argument('--logging',
                             nargs='?', choices=['ERROR',
                                                 'WARN',
@@ -255,6 +715,97 @@ class Config:
     def is_dry(self):
         return self._args.dry or self._dic_tryget('dry')
 
+    @property
+    def engine(self):
+        return self._args.get('engine') or self._dic_tryget('engine')\
+            or 'threads'
+
+    @property
+    def copy_order(self):
+        return self._args.get('copy_order') or \
+            self._dic_tryget('copy_order') or COPY_ORDER_PLAYLIST
+
+    @property
+    def read_ahead(self):
+        """Bytes of sources read ahead of copies, 0 to disable"""
+        mib = self._args.get('read_ahead') or \
+            self._dic_tryget('read_ahead') or 0
+        return max(0, int(mib)) * 1024 * 1024
+
+    @property
+    def fsync(self):
+        return self._dic_tryget('fsync')
+
+    @property
+    def layout(self):
+        return self._args.get('layout') or self._dic_tryget('layout')\
+            or LAYOUT_DIRECTORIES
+
+    @property
+    def plan_out(self):
+        return self._args.get('plan_out')
+
+    @property
+    def all_devices(self):
+        return self._args.get('all_devices') or \
+            self._dic_tryget('all_devices')
+
+    def rate_limits(self, device=None):  # -> dict
+        """Rates of RateLimits for device, from 'default' and the section
+        of its class in 'rate_limits', then arguments"""
+        dic = self._dic_tryget('rate_limits') or {}
+        rates = {}
+        for section in ('default', type(device).__name__):
+            rates.update(dic.get(section) or {})
+        for kind in RateLimits.KINDS:
+            rate = self._args.get('limit_' + kind)
+            if rate is not None:
+                rates[kind] = rate
+        return rates
+
+    @property
+    def verify(self):  # -> VERIFY_FULL, VERIFY_SAMPLE or None
+        return self._args.get('verify') or self._dic_tryget('verify')
+
+    @property
+    def verify_sample_ratio(self):
+        return float(self._dic_tryget('verify_sample_ratio') or
+                     VERIFY_SAMPLE_RATIO)
+
+    @property
+    def progress(self):
+        return self._args.get('progress') or self._dic_tryget('progress')
+
+    @property
+    def is_rescan(self):
+        return self._args.rescan or self._dic_tryget('rescan')
+
+    @property
+    def jobs(self):
+        return max(1, int(self._args.get('jobs') or
+                          self._dic_tryget('jobs') or 1))
+
+    @property
+    def planning_jobs(self):
+        return max(1, int(self._dic_tryget('planning_jobs') or PLANNING_JOBS))
+
+    @property
+    def use_fingerprint_hash(self):
+        return self._dic_tryget('fingerprint_hash') is not False
+
+    @property
+    def use_library_cache(self):
+        return self._dic_tryget('library_cache') is not False
+
+    @property
+    def path(self):
+        return getattr(self._path, 'name', self._path)
+
+    def cache_path(self, filename):
+        """Path of a cache file, which is placed next to the config file"""
+        return os.path.join(os.path.dirname(os.path.abspath(self.path)),
+                            filename)
+
     @staticmethod
     def prepare_default(library=None):
         dic = {
@@ -282,7 +833,26 @@ class Config:
         args = args or CommandArguments()
         with open(path) as f:
             dic = json.load(f)
-            return Config(dic, args, path)
+        config = Config(dic, args, path)
+        config.validate()
+        return config
+
+    def validate(self):
+        """Raise ValueError for unknown values in the config file"""
+        choices = {
+            'fsync': FSYNC_POLICIES,
+            'engine': sorted(EXECUTOR_ENGINES),
+            'layout': LAYOUTS,
+            'copy_order': COPY_ORDERS,
+        }
+        for key, values in choices.items():
+            value = self._dic_tryget(key)
+            if value is not None and value not in values:
+                raise ValueError(_i("Invalid {}: {}, choose from {}")
+                                 .format(key, value, ', '.join(values)))
+        for rates in (self._dic_tryget('rate_limits') or {}).values():
+            for kind, rate in (rates or {}).items():
+                RateLimits.check(kind, rate)
 
 
 # --------------------------------
@@ -297,6 +867,33 @@ def void_fn(*args, **kw):
 
 
 
+def partial_digest(path, size, nbytes=64 * 1024):
+    """SHA-1 hex digest of the head and the tail of a file"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        digest.update(f.read(nbytes))
+        if size > nbytes * 2:
+            f.seek(-nbytes, os.SEEK_END)
+        digest.update(f.read(nbytes))
+    return digest.hexdigest()
+
+
+def file_digest(path, drop_cache=False, chunk_size=1024 * 1024):
+    """SHA-1 hex digest of a whole file.  With drop_cache, cached pages
+    are dropped first, so that bytes are read from the device."""
+    digest = hashlib.sha1()
+    with open(path, 'rb', buffering=0) as f:
+        if drop_cache and hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        buf = memoryview(bytearray(chunk_size))
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            digest.update(buf[:n])  # Releases the GIL
+    return digest.hexdigest()
+
+
 def zipwithindex(iterable, start=0):
     index = start
     for item in iterable:
@@ -327,6 +924,8 @@ class WrapList(ItemWrapperMixin, list):
 
 
 class NameAccessMixin:
+    __slots__ = ()
+
     def __getattr__(self, name):
         if name.startswith('_'):  # Ignore attribute starts with '_'
             return getattr(super(), name)
@@ -413,47 +1012,243 @@ class IncompleteLibraryError(Exception):
 #  Actions {{{
 # --------------------------------
 class Executor:
-    def __init__(self):
+    """Runs actions on a thread pool.
+
+    Actions which have same `ordering_key` (the directory they touch) are
+    ordered: a barrier action (`is_barrier`, e.g. rename or remove) waits
+    for every action submitted before it, and other actions wait only for
+    the last barrier, so copies into a directory run in parallel.
+
+    With `locality`, actions queued while stopped are reordered on start
+    by `locality_key` (where their sources are on disk), keeping them
+    between the same barriers.
+    """
+    def __init__(self, max_workers=1, locality=False):
+        self.max_workers = max_workers
+        self.locality = locality
         self._task_queue = queue.Queue()
+        self._orderings = {}  # ordering_key -> [barrier, followers]
+        self.report = None  # SyncReport
+        self.progress = None  # ProgressBus
+        self.rate_limits = None  # RateLimits of operations but copies
         self.is_stopped = False
-        self.__lock = threading.RLock()  # reentrant lock
+        self._lock = threading.RLock()  # reentrant lock
 
     def start(self):
-        with self.__lock:
+        with self._lock:
             self.is_stopped = False
             self._flush_tasks()
 
     def _flush_tasks(self):
+        tasks = []
         while not self._task_queue.empty():
-            f, args, kw = self._task_queue.get()
-            self.worker.submit(f, *args, **kw)
+            tasks.append(self._task_queue.get())
+        if self.locality:
+            tasks = self.locality_order(tasks)
+        for f, args, kw in tasks:
+            self._submit_worker(f, args, kw)
+
+    @staticmethod
+    def locality_order(tasks):  # -> list<(f, args, kw)>
+        ranked = []
+        epochs = collections.Counter()  # ordering_key -> barriers so far
+        for seq, task in enumerate(tasks):
+            f = task[0]
+            key = getattr(f, 'ordering_key', None)
+            if getattr(f, 'is_barrier', False):
+                epochs[key] += 1
+                rank = (epochs[key], 0, ())
+            else:
+                rank = (epochs[key], 1, getattr(f, 'locality_key', ()))
+            ranked.append((rank, seq, task))
+        ranked.sort(key=lambda item: item[:2])
+        return [task for _, _, task in ranked]
 
     @property
     def worker(self):
-        with self.__lock:
+        with self._lock:
             try:
                 return self._worker
             except AttributeError:
                 self._worker = concurrent.futures.ThreadPoolExecutor(
-                    max_workers=1)
+                    max_workers=self.max_workers)
                 return self._worker
 
     def submit(self, f, *args, **kw):
-        with self.__lock:
+        with self._lock:
             if self.is_stopped:
                 self._task_queue.put((f, args, kw))
             else:
-                self.worker.submit(f, *args, **kw)
+                return self._submit_worker(f, args, kw)
+
+    def _submit_worker(self, f, args, kw):
+        prefetch = getattr(f, 'prefetch', None)
+        if prefetch is not None:
+            prefetch()  # Read its source while earlier actions run
+        if self.progress is not None:
+            self.progress.expect(f)
+        key = getattr(f, 'ordering_key', None)
+        if key is None:
+            return self.worker.submit(self._run, f, (), args, kw)
+        barrier, followers = self._orderings.setdefault(key, [None, []])
+        is_barrier = getattr(f, 'is_barrier', False)
+        deps = followers + [barrier] if is_barrier else [barrier]
+        deps = [dep for dep in deps if dep is not None and not dep.done()]
+        # Dependencies were submitted earlier, so they are already running
+        # when this task starts waiting for them.
+        future = self.worker.submit(self._run, f, deps, args, kw)
+        if is_barrier:
+            self._orderings[key] = [future, []]
+        else:
+            followers.append(future)
+        return future
+
+    def _run(self, f, deps, args, kw):
+        if deps:
+            concurrent.futures.wait(deps)
+        started = self._started(f)
+        try:
+            return self._call(f, args, kw)
+        except Exception as e:
+            self._failed(f, e)
+            raise
+        finally:
+            self._finished(f, started)
+
+    def _call(self, f, args, kw):
+        if self.rate_limits is not None and not getattr(f, 'is_bulk', False):
+            self.rate_limits.ops.acquire()
+        profiler = getattr(self.report, 'profiler', None)
+        if profiler is None:
+            return f(*args, **kw)
+        with profiler.thread('execute'):
+            return f(*args, **kw)
+
+    def _started(self, f):  # -> float
+        if self.progress is not None:
+            self.progress.started(f)
+        return time.perf_counter()
+
+    def _failed(self, f, e):
+        error(_i("Failed to execute {}: {}").format(f, e))
+        if self.report is not None:
+            self.report.record_failure(f)
+        if self.progress is not None:
+            self.progress.failed(f, e)
+
+    def _finished(self, f, started):
+        if self.report is not None:
+            self.report.record_action(f, time.perf_counter() - started)
+        if self.progress is not None:
+            self.progress.completed(f)
 
     def stop(self):
-        with self.__lock:
+        with self._lock:
             if not self.is_stopped:
                 self.worker.shutdown()
                 del self._worker
+                self._orderings.clear()
+                self.is_stopped = True
+
+    shutdown = stop
+
+
+class AsyncLoopWorker:
+    """Event loop running in its own thread, accepting coroutines"""
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine_fn, *args):  # -> concurrent.futures.Future
+        future = asyncio.run_coroutine_threadsafe(coroutine_fn(*args),
+                                                  self.loop)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def shutdown(self, wait=True):
+        while wait:
+            with self._lock:
+                pending = list(self._pending)
+            if not pending:
+                break
+            concurrent.futures.wait(pending)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+class AsyncExecutor(Executor):
+    """Runs actions as tasks of an asyncio event loop.
+
+    Actions are ordered same as Executor.  Bulk actions (copies) run on
+    `max_workers` threads, and other file operations, which are mostly
+    waiting for the device, run on a separate pool with at most
+    `max_metadata` of them in flight.  Waiting actions are tasks instead
+    of blocked threads.  Only execution runs on the loop; planning and
+    reading the library stay on threads of the syncer.
+    """
+    def __init__(self, max_workers=1, max_metadata=32, locality=False):
+        super().__init__(max_workers, locality)
+        self.max_metadata = max_metadata
+
+    @property
+    def worker(self):
+        with self._lock:
+            try:
+                return self._worker
+            except AttributeError:
+                self._worker = AsyncLoopWorker()
+                self._bulk_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers)
+                self._metadata_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_metadata)
+                return self._worker
+
+    def stop(self):
+        with self._lock:
+            if self.is_stopped:
+                return
+            if hasattr(self, '_worker'):
+                super().stop()
+                self._bulk_pool.shutdown()
+                self._metadata_pool.shutdown()
+            else:  # Loop and pools have not been started
+                self._orderings.clear()
                 self.is_stopped = True
 
     shutdown = stop
 
+    async def _run(self, f, deps, args, kw):
+        if deps:
+            await asyncio.wait([asyncio.wrap_future(dep) for dep in deps])
+        if getattr(f, 'is_bulk', False):
+            pool = self._bulk_pool
+        else:
+            pool = self._metadata_pool
+        loop = asyncio.get_event_loop()
+        started = self._started(f)
+        try:
+            return await loop.run_in_executor(
+                pool, functools.partial(self._call, f, args, kw))
+        except Exception as e:
+            self._failed(f, e)
+            raise
+        finally:
+            self._finished(f, started)
+
 
 class ExecutorSuspender:
     def __init__(self, executor):
@@ -466,6 +1261,12 @@ class ExecutorSuspender:
         self.executor.start()
 
 
+EXECUTOR_ENGINES = {
+    'threads': Executor,
+    'async': AsyncExecutor,
+}
+
+
 class DryExecutor(Executor):
     def submit(self, f, *args, **kw):
         try:
@@ -474,6 +1275,24 @@ class DryExecutor(Executor):
             info("DRYRUN: Submitting {}".format(repr(f)))
 
 
+class PlanRecorder(Executor):
+    """Keeps submitted actions in order, instead of running them"""
+    def __init__(self):
+        super().__init__()
+        self.actions = []
+
+    def submit(self, f, *args, **kw):
+        self.actions.append(f)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    shutdown = stop
+
+
 class ExecutorService(dict):
     DEFAULT_KEY = '_default'
 
@@ -518,42 +1337,54 @@ def event(*args, **kw):
 
 
 class EventProvider:
+    """Events of instances, which live as long as their instances"""
     def __init__(self, doc=None):
         self.__doc__ = doc
-        self._objects = {}
+        self._objects = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
 
     def __get__(self, obj, objtype=None):
         if obj is None:
             return self
-        try:
-            return self._objects[obj]
-        except KeyError:
-            handler = self._objects[obj] = Event(self, obj)
-            return handler
+        with self._lock:
+            try:
+                return self._objects[obj]
+            except KeyError:
+                handler = self._objects[obj] = Event(self, obj)
+                return handler
 
     def __set__(self, obj, value):
         pass
 
+    def fire(self, obj, *args, **kw):
+        """Fire the event of obj, without creating one nobody subscribed"""
+        handler = self._objects.get(obj)
+        if handler is not None:
+            handler.fire(*args, **kw)
+
 
 class Event:
     def __init__(self, provider, target):
         self._provider = provider
-        self._target = target
-        self.handlers = []
-        self.__handlers_lock = threading.RLock()
+        self._target = weakref.ref(target)
+        self.handlers = ()  # Replaced on changes, so fire needs no lock
+        self.__handlers_lock = threading.Lock()
 
     def fire(self, *args, **kw):
-        with self.__handlers_lock:
-            for h in self.handlers:
-                h(*args, **kw)
+        for h in self.handlers:
+            h(*args, **kw)
 
     def subscribe(self, f):
         with self.__handlers_lock:
-            self.handlers.append(f)
+            self.handlers += (f,)
+        return self
 
     def unsubscribe(self, f):
         with self.__handlers_lock:
-            self.handlers.remove(f)
+            handlers = list(self.handlers)
+            handlers.remove(f)
+            self.handlers = tuple(handlers)
+        return self
 
     __call__ = fire
     __iadd__ = subscribe
@@ -569,7 +1400,7 @@ class Action:
             self.dryrun(*args, **kw)
         else:
             self.run(*args, **kw)
-        self.on_completed(*args, **kw)
+        type(self).on_completed.fire(self, *args, **kw)
 
     __call__ = start
 
@@ -581,6 +1412,19 @@ class Action:
         pass
 
 
+def file_state(path, manifest=None):  # -> dict or None
+    """Size and mtime of a file, from its manifest entry if known"""
+    entry = manifest.entry(path) if manifest is not None else None
+    if entry and entry.get('size') is not None and \
+            entry.get('mtime') is not None:
+        return {'size': entry['size'], 'mtime': entry['mtime']}
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+
 class VoidAction(Action):
     instance = Action()
     def __new__(cls):
@@ -600,43 +1444,1017 @@ CompositeAction = Task
 
 
 class TwoParamAction(Action):
-    def __init__(self, src, dst):
+    def __init__(self, src, dst, manifest=None):
         self.src = src
         self.dst = dst
+        self.manifest = manifest
+
+    @property
+    def ordering_key(self):
+        return os.path.dirname(self.dst)
 
     @property
     def short_repr(self):
         return os.path.basename(self.src)
 
 
+class CopyStrategyUnavailable(Exception):
+    pass
+
+
+class CopyStrategy:
+    """Helpers of strategies.  transfer(fsrc, fdst, size, chunk_size) of
+    a strategy copies at most size bytes from current positions, and
+    raises CopyStrategyUnavailable when nothing could be copied by it."""
+    name = None
+
+    def _filenos(self, fsrc, fdst):
+        try:
+            infd = fsrc.fileno()
+        except io.UnsupportedOperation as ex:  # In-memory source
+            raise CopyStrategyUnavailable(ex)
+        # Bytes written through fdst, e.g. chunks read ahead, must reach
+        # the descriptor before the kernel writes at its position.
+        fdst.flush()
+        return infd, fdst.fileno()
+
+    def _unavailable(self, ex, copied):
+        if copied == 0 and ex.errno in (errno.ENOSYS, errno.EXDEV,
+                                        errno.EINVAL, errno.EOPNOTSUPP,
+                                        errno.ENOTSOCK, errno.EBADF):
+            raise CopyStrategyUnavailable(ex)
+        raise ex
+
+
+class CopyFileRangeStrategy(CopyStrategy):
+    """In-kernel copy, which may be offloaded to the file system"""
+    name = 'copy_file_range'
+
+    def transfer(self, fsrc, fdst, size, chunk_size):
+        if not hasattr(os, 'copy_file_range'):
+            raise CopyStrategyUnavailable()
+        infd, outfd = self._filenos(fsrc, fdst)
+        copied = 0
+        while copied < size:
+            try:
+                n = os.copy_file_range(infd, outfd,
+                                       min(chunk_size, size - copied))
+            except OSError as ex:
+                self._unavailable(ex, copied)
+            if n == 0:
+                break
+            copied += n
+        return copied
+
+
+class SendfileStrategy(CopyStrategy):
+    """In-kernel copy through the page cache"""
+    name = 'sendfile'
+
+    def transfer(self, fsrc, fdst, size, chunk_size):
+        if not hasattr(os, 'sendfile') or not sys.platform.startswith('linux'):
+            raise CopyStrategyUnavailable()
+        infd, outfd = self._filenos(fsrc, fdst)
+        copied = 0
+        while copied < size:
+            try:
+                n = os.sendfile(outfd, infd, None,
+                                min(chunk_size, size - copied))
+            except OSError as ex:
+                self._unavailable(ex, copied)
+            if n == 0:
+                break
+            copied += n
+        return copied
+
+
+class ReadintoStrategy(CopyStrategy):
+    """Plain reads and writes through a reusable buffer per thread"""
+    name = 'readinto'
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def buffer(self, chunk_size):
+        buf = getattr(self._local, 'buffer', None)
+        if buf is None or len(buf) != chunk_size:
+            buf = self._local.buffer = memoryview(bytearray(chunk_size))
+        return buf
+
+    def transfer(self, fsrc, fdst, size, chunk_size):
+        buf = self.buffer(chunk_size)
+        copied = 0
+        while copied < size:
+            n = fsrc.readinto(buf[:min(chunk_size, size - copied)])
+            if not n:
+                break
+            fdst.write(buf[:n])
+            copied += n
+        return copied
+
+
+class CopyEngine:
+    """Copies files with the first usable strategy.
+
+    Chunk size, strategies and preallocation are tuned by Device.
+
+    Files are written to a temporary name and renamed when complete, so
+    an interrupted copy never leaves a truncated file under its name.
+    With FSYNC_FILE, each file and its directory are synced after the
+    rename.  With FSYNC_PLAYLIST, files copied into a directory and then
+    the directory are synced when `flush` is called for it, instead of
+    per file.  With FSYNC_NONE nothing is synced, and interrupted copies
+    start over instead of resuming.
+    """
+    PART_PREFIX = '.isync-part '
+    CHECKPOINT_BYTES = 32 * 1024 * 1024
+    STRATEGIES = dict((s.name, s) for s in (
+        CopyFileRangeStrategy(), SendfileStrategy(), ReadintoStrategy()))
+
+    def __init__(self, strategies=('copy_file_range', 'sendfile', 'readinto'),
+                 chunk_size=1024 * 1024, preallocate=False,
+                 fsync_policy=FSYNC_PLAYLIST):
+        self.strategies = [self.STRATEGIES[name] for name in strategies]
+        self.chunk_size = chunk_size
+        self.preallocate = preallocate
+        self.fsync_policy = fsync_policy
+        self.fanout = None  # FanOutCache shared with other devices
+        self.read_ahead = None  # ReadAhead of upcoming sources
+        self.progress = None  # ProgressBus notified of copied bytes
+        self.rate_limits = None  # RateLimits of reads and writes
+        self._unwritten = {}  # dirpath -> list<path> not synced
+        self._lock = threading.Lock()
+
+    @classmethod
+    def part_path(cls, dst):
+        dirpath, name = os.path.split(dst)
+        return os.path.join(dirpath, cls.PART_PREFIX + name)
+
+    def copy(self, src, dst, resume=0, checkpoint=None):  # -> int
+        """Copy src to dst, and return the number of bytes copied.
+
+        resume: offset up to which the temporary file of an interrupted
+        copy is known to be durable.  checkpoint: callable(offset), called
+        after every CHECKPOINT_BYTES are made durable.
+        """
+        if self.fsync_policy == FSYNC_NONE:
+            checkpoint = None  # Offsets would not be durable
+        part = self.part_path(dst)
+        try:
+            fdst = open(part, 'r+b' if resume else 'wb')
+        except FileNotFoundError:
+            # Directories are not created while planning
+            os.makedirs(os.path.dirname(part), exist_ok=True)
+            fdst, resume = open(part, 'wb'), 0
+        with self._open_source(src, resume) as fsrc, fdst:
+            fsrc.seek(0, os.SEEK_END)
+            size = fsrc.tell()
+            if resume > size:
+                resume = 0
+            fdst.truncate(resume)
+            self._advise(fsrc, size)
+            self._preallocate(fdst, size)
+            fsrc.seek(resume)
+            fdst.seek(resume)
+            offset = resume
+            step = self.CHECKPOINT_BYTES if checkpoint else size
+            limits = self.rate_limits
+            if limits is not None and limits.is_limited:
+                step = min(step, self.chunk_size)  # Throttled per chunk
+            next_checkpoint = offset + self.CHECKPOINT_BYTES
+            while offset < size:
+                n = self.transfer(fsrc, fdst, min(step, size - offset))
+                if n == 0:
+                    break
+                offset += n
+                if self.progress is not None:
+                    self.progress.copied(n)
+                if limits is not None:
+                    limits.transferred(n)
+                if checkpoint is not None and next_checkpoint <= offset < size:
+                    fdst.flush()
+                    os.fsync(fdst.fileno())
+                    checkpoint(offset)
+                    next_checkpoint = offset + self.CHECKPOINT_BYTES
+            fdst.flush()
+            if self.fsync_policy == FSYNC_FILE:
+                os.fsync(fdst.fileno())  # Before it gets its name
+        try:
+            shutil.copymode(src, part)
+        except OSError:
+            pass  # Some file systems do not have permission bits
+        os.replace(part, dst)
+        copied = offset - resume
+        if self.fsync_policy == FSYNC_FILE:
+            self._fsync_dir(os.path.dirname(dst))
+        elif self.fsync_policy == FSYNC_PLAYLIST:
+            with self._lock:
+                self._unwritten.setdefault(
+                    os.path.dirname(dst), []).append(dst)
+        return copied
+
+    def prefetch(self, src):
+        """Hint that src is copied soon"""
+        if self.read_ahead is not None and self.fanout is None:
+            self.read_ahead.prefetch(src)
+
+    def _open_source(self, src, resume=0):
+        data = self.fanout.read(src, self) if self.fanout is not None \
+            else None
+        if data is not None:
+            return io.BytesIO(data)
+        if self.read_ahead is not None:
+            source = self.read_ahead.open(src)
+            if source is not None and not resume:
+                return source
+            if source is not None:
+                source.close()  # Read ahead from the beginning
+        return open(src, 'rb')
+
+    def transfer(self, fsrc, fdst, size):
+        if isinstance(fsrc, ReadAheadSource):
+            copied = fsrc.write_to(fdst, size)
+            if copied:
+                return copied
+        for strategy in self.strategies:
+            try:
+                return strategy.transfer(fsrc, fdst, size, self.chunk_size)
+            except CopyStrategyUnavailable:
+                debug("{} is not available".format(strategy.name))
+        raise CopyStrategyUnavailable(_i("No copy strategy is available"))
+
+    def _advise(self, fsrc, size):
+        if hasattr(os, 'posix_fadvise') and \
+                not isinstance(fsrc, (io.BytesIO, ReadAheadSource)):
+            os.posix_fadvise(fsrc.fileno(), 0, size,
+                             os.POSIX_FADV_SEQUENTIAL)
+
+    def _preallocate(self, fdst, size):
+        if self.preallocate and size > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fdst.fileno(), 0, size)
+            except OSError:
+                pass
+
+    def flush(self, dirpath):
+        """Make files copied into dirpath and their names durable"""
+        with self._lock:
+            paths = self._unwritten.pop(dirpath, None)
+        if not paths:
+            return
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue  # Moved or removed after copying
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self._fsync_dir(dirpath)
+
+    @staticmethod
+    def _fsync_dir(dirpath):
+        if hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(dirpath, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass  # Not supported by some file systems
+            finally:
+                os.close(fd)
+
+    def close(self):
+        if self.read_ahead is not None:
+            self.read_ahead.close()
+
+CopyEngine.default = CopyEngine()
+
+
+class TokenBucket:
+    """Allows `rate` units per second on average, in bursts of up to a
+    second of them.  rate None is unlimited.  It may be changed at any
+    time, and waiting threads follow the new rate."""
+    def __init__(self, rate=None):
+        self._rate = rate or None
+        self._tokens = float(rate or 0)
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate):
+        with self._cond:
+            self._refill()
+            self._rate = rate or None
+            if self._rate is None:
+                self._tokens = 0.0
+            self._cond.notify_all()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self._rate is not None:
+            self._tokens = min(self._rate, self._tokens +
+                               (now - self._updated) * self._rate)
+        self._updated = now
+
+    def acquire(self, amount=1):
+        """Take amount, waiting while more were taken than allowed"""
+        if self._rate is None:
+            return
+        with self._cond:
+            self._refill()
+            self._tokens -= amount
+            while self._rate is not None and self._tokens < 0:
+                self._cond.wait(-self._tokens / self._rate)
+                self._refill()
+
+
+class RateLimits:
+    """Limits of a sync, to keep the machine usable while syncing.
+
+    read and write limit bytes per second of sources and of the device,
+    and ops other file operations per second.  Rates are given in MB/s
+    and operations/s, from `rate_limits` of the Device class, then of
+    the config, then `override`, which also applies to running syncs.
+    """
+    KINDS = ('read', 'write', 'ops')
+    UNITS = {'read': 1000000, 'write': 1000000, 'ops': 1}
+
+    def __init__(self):
+        self.read = TokenBucket()
+        self.write = TokenBucket()
+        self.ops = TokenBucket()
+        self.overrides = {}  # kind -> rate, kept over configure
+
+    @staticmethod
+    def parse(items):  # -> dict
+        """Rates from ['KIND=RATE', ...], where RATE may be 'off'"""
+        rates = {}
+        for item in items:
+            kind, _, rate = item.partition('=')
+            if kind not in RateLimits.KINDS or not rate:
+                raise ValueError(_i("Invalid rate limit: {}").format(item))
+            rates[kind] = RateLimits.check(kind, rate)
+        return rates
+
+    @staticmethod
+    def check(kind, rate):  # -> float or None
+        """rate of kind as float, None if it is None or 'off'.  Raise
+        ValueError unless it is positive, since a bucket never fills up
+        otherwise."""
+        if rate is None or rate == 'off':
+            return None
+        try:
+            value = float(rate)
+        except (TypeError, ValueError):
+            value = 0.0
+        if kind not in RateLimits.KINDS or not value > 0:
+            raise ValueError(_i("Invalid rate limit: {}={}, rates must be \
+positive or off").format(kind, rate))
+        return value
+
+    def configure(self, device=None, config=None):
+        rates = dict(getattr(device, 'rate_limits', {}))
+        if hasattr(config, 'rate_limits'):
+            rates.update(config.rate_limits(device))
+        rates.update(self.overrides)
+        self._apply(rates)
+
+    def override(self, **rates):
+        self.overrides.update(rates)
+        self._apply(rates)
+
+    def _apply(self, rates):
+        for kind, rate in rates.items():
+            rate = self.check(kind, rate)
+            getattr(self, kind).rate = \
+                rate * self.UNITS[kind] if rate is not None else None
+
+    @property
+    def is_limited(self):
+        return any(getattr(self, kind).rate is not None
+                   for kind in self.KINDS)
+
+    def transferred(self, size):
+        self.read.acquire(size)
+        self.write.acquire(size)
+
+
+class ReadAheadStream:
+    """A source file opened by ReadAhead, and its chunks not written yet"""
+    PENDING, OPENING, READING, STOPPED = range(4)
+    __slots__ = ('path', 'file', 'size', 'state', 'chunks', 'end',
+                 'claimed', 'closed')
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None  # Unbuffered, positioned at end
+        self.size = 0
+        self.state = self.PENDING
+        self.chunks = collections.deque()  # (buffer, length)
+        self.end = 0
+        self.claimed = False  # Its copy is running
+        self.closed = False
+
+
+class ReadAhead:
+    """Reads sources of upcoming copies on reader threads, while copy
+    workers write earlier ones to the device.
+
+    Chunks are read into reused buffers of at most `limit` bytes.  A copy
+    whose source is not opened yet reads it by itself, and a copy which
+    caught up with its reader while no buffer is free reads the rest of
+    the file by itself, so copies never wait for buffers of other copies.
+    """
+    READERS = 2
+
+    def __init__(self, limit, chunk_size, readers=READERS):
+        self.chunk_size = chunk_size
+        self.capacity = max(1, limit // chunk_size)  # Buffers
+        self.readers = readers
+        self._free = []
+        self._allocated = 0
+        self._pending = collections.deque()  # ReadAheadStream to open
+        self._streams = {}  # path -> deque<ReadAheadStream>
+        self._threads = 0
+        self._cond = threading.Condition()
+
+    def prefetch(self, path):
+        stream = ReadAheadStream(path)
+        with self._cond:
+            self._pending.append(stream)
+            self._streams.setdefault(path, collections.deque()).append(stream)
+            if self._threads < self.readers:
+                self._threads += 1
+                threading.Thread(target=self._read_streams,
+                                 daemon=True).start()
+
+    def open(self, path):  # -> ReadAheadSource or None
+        """Source of a copy of path, None if it should be opened as usual"""
+        with self._cond:
+            streams = self._streams.get(path)
+            if not streams:
+                return None
+            stream = streams.popleft()
+            if not streams:
+                del self._streams[path]
+            if stream.state == stream.PENDING:
+                stream.closed = True  # Skipped by readers
+                return None
+            while stream.state == stream.OPENING:
+                self._cond.wait()
+            if stream.file is None:
+                return None
+            stream.claimed = True
+            self._cond.notify_all()
+        return ReadAheadSource(self, stream)
+
+    def release(self, stream):
+        with self._cond:
+            stream.closed = True
+            while stream.chunks:
+                self._free.append(stream.chunks.popleft()[0])
+            if stream.state != stream.READING and stream.file is not None:
+                stream.file.close()  # Otherwise closed by its reader
+                stream.file = None
+            self._cond.notify_all()
+
+    def close(self):
+        """Drop sources of copies which did not run"""
+        with self._cond:
+            streams = [stream for streams in self._streams.values()
+                       for stream in streams]
+            self._streams.clear()
+            self._pending.clear()
+        for stream in streams:
+            self.release(stream)
+
+    def _read_streams(self):
+        while True:
+            with self._cond:
+                if not self._pending:
+                    self._threads -= 1
+                    return
+                stream = self._pending.popleft()
+                if stream.closed:
+                    continue
+                stream.state = stream.OPENING
+            self._read_stream(stream)
+
+    def _read_stream(self, stream):
+        try:
+            f = open(stream.path, 'rb', buffering=0)
+        except OSError:
+            f = None
+        with self._cond:
+            if f is not None:
+                stream.file = f
+                stream.size = os.fstat(f.fileno()).st_size
+                stream.state = stream.READING
+            else:
+                stream.state = stream.STOPPED
+            self._cond.notify_all()
+        if f is None:
+            return
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, stream.size,
+                             os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            buf = self._acquire(stream)
+            if buf is None:
+                break
+            try:
+                n = f.readinto(
+                    buf[:min(self.chunk_size, stream.size - stream.end)])
+            except OSError:
+                n = 0  # Its copy reads it again and fails
+            with self._cond:
+                if n:
+                    stream.chunks.append((buf, n))
+                    stream.end += n
+                else:
+                    self._free.append(buf)
+                self._cond.notify_all()
+            if not n:
+                break
+        with self._cond:
+            stream.state = stream.STOPPED
+            if stream.closed:
+                f.close()
+                stream.file = None
+            self._cond.notify_all()
+
+    def _acquire(self, stream):  # -> memoryview or None
+        """Buffer for the next chunk of stream, None to stop reading it"""
+        with self._cond:
+            while True:
+                if stream.closed or stream.end >= stream.size:
+                    return None
+                if self._free:
+                    return self._free.pop()
+                if self._allocated < self.capacity:
+                    self._allocated += 1
+                    return memoryview(bytearray(self.chunk_size))
+                if stream.claimed:
+                    return None  # Its copy reads the rest
+                self._cond.wait()
+
+
+class ReadAheadSource(io.RawIOBase):
+    """Source file of a copy, whose chunks read ahead are written first"""
+    def __init__(self, read_ahead, stream):
+        super().__init__()
+        self._read_ahead = read_ahead
+        self._stream = stream
+        self._position = 0
+        self._offset = 0  # Bytes consumed
+        self._head = 0  # Bytes consumed of the first chunk
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._stream.size
+        self._position = offset
+        return offset
+
+    def fileno(self):
+        """Descriptor positioned at the rest, once chunks are written"""
+        if self._peek(0) is not None:
+            raise io.UnsupportedOperation(_i("Chunks are not written yet"))
+        return self._stream.file.fileno()
+
+    def readinto(self, b):
+        view = self._peek(len(b))
+        if view is None:
+            n = self._stream.file.readinto(b) or 0
+            self._offset = self._position = self._offset + n
+        else:
+            n = len(view)
+            b[:n] = view
+            self._consume(n)
+        return n
+
+    def write_to(self, fdst, size):  # -> int
+        """Write chunks read ahead, without copying them again"""
+        copied = 0
+        while copied < size:
+            view = self._peek(size - copied)
+            if view is None:
+                break
+            fdst.write(view)
+            self._consume(len(view))
+            copied += len(view)
+        return copied
+
+    def _peek(self, limit):  # -> memoryview or None
+        """Next bytes read ahead, None when the rest should be read from
+        the file"""
+        if self._position != self._offset:
+            raise io.UnsupportedOperation(_i("Only sequential reads"))
+        stream = self._stream
+        with self._read_ahead._cond:
+            while not stream.chunks and stream.state == stream.READING:
+                self._read_ahead._cond.wait()
+            if not stream.chunks:
+                return None
+            buf, length = stream.chunks[0]
+        return buf[self._head:min(length, self._head + limit)]
+
+    def _consume(self, n):
+        self._offset = self._position = self._offset + n
+        self._head += n
+        with self._read_ahead._cond:
+            buf, length = self._stream.chunks[0]
+            if self._head == length:
+                self._stream.chunks.popleft()
+                self._head = 0
+                self._read_ahead._free.append(buf)
+                self._read_ahead._cond.notify_all()
+
+    def close(self):
+        if not self.closed:
+            self._read_ahead.release(self._stream)
+        super().close()
+
+
+class FanOutCache:
+    """Contents of source files which are copied to several devices.
+
+    A file expected by more than one device is read by the first one
+    writing it, and kept in memory until every device wrote it, so that
+    each device proceeds at its own speed.  Files which do not fit in
+    `limit` bytes are read by each device instead.  Devices are told
+    apart by an owner, which releases files it did not read, e.g. of
+    failed copies, when it finishes.
+    """
+    LIMIT = 256 * 1024 * 1024
+
+    def __init__(self, limit=LIMIT):
+        self.limit = limit
+        self.hits = 0
+        self._wanted = collections.Counter()  # path -> devices to write
+        self._claims = {}  # owner -> Counter of paths not read yet
+        self._data = {}  # path -> bytes
+        self._loading = {}  # path -> threading.Event
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def expect(self, path, owner=None):
+        with self._lock:
+            self._wanted[path] += 1
+            self._claims.setdefault(
+                owner, collections.Counter())[path] += 1
+
+    def read(self, path, owner=None):  # -> bytes or None
+        """Contents of path, or None if it should be read from disk"""
+        while True:
+            with self._lock:
+                if not self._claims.get(owner, {}).get(path):
+                    return None  # Not expected, e.g. copied again
+                if path in self._data:
+                    self.hits += 1
+                    return self._take(path, owner)
+                loading = self._loading.get(path)
+                if loading is None:
+                    size = self._reserve(path) \
+                        if self._wanted[path] >= 2 else None
+                    if size is None:
+                        self._unclaim(path, owner)
+                        return None
+                    self._loading[path] = threading.Event()
+                    break
+            loading.wait()
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            data = None
+        with self._lock:
+            self._loading.pop(path).set()
+            if data is None:
+                self._bytes -= size
+                self._unclaim(path, owner)
+                return None
+            self._bytes += len(data) - size  # Changed since reserved
+            self._data[path] = data
+            return self._take(path, owner)
+
+    def _reserve(self, path):  # -> int or None
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        if self._bytes + size > self.limit:
+            return None
+        self._bytes += size
+        return size
+
+    def _take(self, path, owner):
+        data = self._data[path]
+        self._unclaim(path, owner)
+        return data
+
+    def _unclaim(self, path, owner, count=1):
+        self._claims[owner][path] -= count
+        self._wanted[path] -= count
+        if self._wanted[path] <= 0:
+            del self._wanted[path]
+            data = self._data.pop(path, None)
+            if data is not None:
+                self._bytes -= len(data)
+
+    def release(self, owner=None):
+        """Give up files expected by owner and not read by it"""
+        with self._lock:
+            claims = self._claims.get(owner, {})
+            for path, count in list(claims.items()):
+                if count > 0:
+                    self._unclaim(path, owner, count)
+            self._claims.pop(owner, None)
+
+
 class FileCopyAction(TwoParamAction):
+    is_bulk = True
+
+    def __init__(self, src, dst, manifest=None, track_id=None,
+                 fingerprint=None, engine=None):
+        super().__init__(src, dst, manifest)
+        self.track_id = track_id
+        self.fingerprint = fingerprint
+        self.engine = engine or CopyEngine.default
+
     def run(self):
         info(_i("Copying {}".format(self.short_repr)))
-        shutil.copy(self.src, self.dst)
+        if self.manifest is None:
+            self.copied_bytes = self.engine.copy(self.src, self.dst)
+            return
+        self.copied_bytes = self.engine.copy(
+            self.src, self.dst,
+            self.manifest.resume_offset(self.dst, self.fingerprint),
+            self.checkpoint if self.fingerprint is not None else None)
+        self.manifest.record(self.dst, self.track_id, self.fingerprint)
+
+    def checkpoint(self, offset):
+        self.manifest.progress(self.dst, offset, self.fingerprint)
+
+    @property
+    def expected_bytes(self):
+        try:
+            return os.path.getsize(self.src)
+        except OSError:
+            return 0
+
+    def prefetch(self):
+        self.engine.prefetch(self.src)
+
+    @property
+    def locality_key(self):
+        """Source directory and inode, which roughly follow the order of
+        files on disk, then the destination directory"""
+        try:
+            st = os.stat(self.src)
+            dev, ino = st.st_dev, st.st_ino
+        except OSError:
+            dev = ino = 0
+        return (dev, os.path.dirname(self.src), ino,
+                os.path.dirname(self.dst))
+
+    def to_plan(self):
+        return {'op': 'copy', 'src': self.src, 'dst': self.dst,
+                'track_id': self.track_id, 'fingerprint': self.fingerprint,
+                'expect': [[self.src, file_state(self.src)]]}
+
+    @classmethod
+    def from_plan(cls, dic, manifest, engine):
+        return cls(dic['src'], dic['dst'], manifest, dic['track_id'],
+                   dic['fingerprint'], engine)
 
     def __str__(self):
         return "COPY {0} -> {1}".format(self.src, self.dst)
 
 
 class FileMoveAction(TwoParamAction):
+    is_barrier = True
+
     def run(self):
         info(_i("Moving {}".format(self.short_repr)))
         shutil.move(self.src, self.dst)
+        if self.manifest is not None:
+            self.manifest.move(self.src, self.dst)
 
     def __str__(self):
         return "MOVE {0} -> {1}".format(self.src, self.dst)
 
+    def to_plan(self):
+        return {'op': 'move', 'src': self.src, 'dst': self.dst,
+                'expect': [[self.src, file_state(self.src, self.manifest)]]}
+
+    @classmethod
+    def from_plan(cls, dic, manifest, engine):
+        return cls(dic['src'], dic['dst'], manifest)
+
 
 class FileRemoveAction(Action):
-    def __init__(self, path):
+    is_barrier = True
+
+    def __init__(self, path, manifest=None):
         self.path = path
+        self.manifest = manifest
+
+    @property
+    def ordering_key(self):
+        return os.path.dirname(self.path)
+
+    @property
+    def short_repr(self):
+        return os.path.basename(self.path)
 
     def run(self):
         info(_i("Removing {}".format(self.short_repr)))
         os.remove(self.path)
+        if self.manifest is not None:
+            self.manifest.forget(self.path)
+
+    def __str__(self):
+        return "REMOVE {0}".format(self.path)
+
+    def to_plan(self):
+        return {'op': 'remove', 'path': self.path,
+                'expect': [[self.path, file_state(self.path, self.manifest)]]}
+
+    @classmethod
+    def from_plan(cls, dic, manifest, engine):
+        return cls(dic['path'], manifest)
+
+
+class FileWriteAction(Action):
+    def __init__(self, path, text, manifest=None, fingerprint=None):
+        self.path = path
+        self.text = text
+        self.manifest = manifest
+        self.fingerprint = fingerprint
+
+    @property
+    def ordering_key(self):
+        return os.path.dirname(self.path)
+
+    @property
+    def short_repr(self):
+        return os.path.basename(self.path)
+
+    def run(self):
+        info(_i("Writing {}".format(self.short_repr)))
+        tmppath = self.path + '.tmp'
+        with open(tmppath, 'w', encoding='utf-8') as f:
+            f.write(self.text)
+        os.replace(tmppath, self.path)
+        if self.manifest is not None:
+            self.manifest.record(self.path, None, self.fingerprint)
+
+    def __str__(self):
+        return "WRITE {0}".format(self.path)
+
+    def to_plan(self):
+        return {'op': 'write', 'path': self.path, 'text': self.text,
+                'fingerprint': self.fingerprint, 'expect': []}
+
+    @classmethod
+    def from_plan(cls, dic, manifest, engine):
+        return cls(dic['path'], dic['text'], manifest, dic['fingerprint'])
+
+
+class FlushAction(Action):
+    """Waits for actions in a directory and makes the copies durable"""
+    is_barrier = True
+
+    def __init__(self, engine, dirpath):
+        self.engine = engine
+        self.ordering_key = dirpath
+
+    def run(self):
+        self.engine.flush(self.ordering_key)
 
     def __str__(self):
-        return "REMOVE {0}".format(self.src, self.dst)
+        return "FLUSH {0}".format(self.ordering_key)
+
+    def to_plan(self):
+        return {'op': 'flush', 'path': self.ordering_key, 'expect': []}
+
+    @classmethod
+    def from_plan(cls, dic, manifest, engine):
+        return cls(engine, dic['path'])
+
+
+# Actions saved in plans.  to_plan returns arguments to rebuild one by
+# from_plan, with 'op' naming its class here and 'expect' listing
+# [path, file_state] of files which must be unchanged when applied.
+PLAN_ACTIONS = {
+    'copy': FileCopyAction,
+    'move': FileMoveAction,
+    'remove': FileRemoveAction,
+    'write': FileWriteAction,
+    'flush': FlushAction,
+}
+
+
+class SyncPlanFile:
+    """Actions of a sync, saved to be reviewed and applied later.
+
+    Actions expect files they read or replace to have the size and mtime
+    seen when planning.  A plan is applied only if all of them hold,
+    except files produced by earlier actions of the plan.
+    """
+    VERSION = 1
+
+    def __init__(self, root_dir, manifest_path, engine, actions,
+                 digests=None):
+        """engine: dict of CopyEngine arguments, actions: list<dict>"""
+        self.root_dir = root_dir
+        self.manifest_path = manifest_path
+        self.engine = engine
+        self.actions = actions
+        self.digests = digests or {}  # dirpath -> digest of the playlist
+
+    @staticmethod
+    def from_syncer(syncer, actions):
+        engine = syncer.copy_engine
+        return SyncPlanFile(
+            syncer.device.root_dir, syncer.device.manifest_path,
+            {'strategies': [st.name for st in engine.strategies],
+             'chunk_size': engine.chunk_size,
+             'preallocate': engine.preallocate,
+             'fsync_policy': engine.fsync_policy},
+            [action.to_plan() for action in actions],
+            syncer._synced_digests)
+
+    @staticmethod
+    def load(path):
+        with open(path, encoding='utf-8') as f:
+            dic = json.load(f)
+        if dic.get('version') != SyncPlanFile.VERSION:
+            raise ValueError(_i("Unsupported plan version: {}")
+                             .format(dic.get('version')))
+        return SyncPlanFile(dic['root_dir'], dic['manifest'],
+                            dic['engine'], dic['actions'], dic['digests'])
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'version': self.VERSION,
+                       'root_dir': self.root_dir,
+                       'manifest': self.manifest_path,
+                       'engine': self.engine,
+                       'digests': self.digests,
+                       'actions': self.actions}, f,
+                      ensure_ascii=False, indent=1)
+
+    def conflicts(self):  # -> list<str>
+        produced = set()
+        conflicts = []
+        for dic in self.actions:
+            for path, state in dic['expect']:
+                if path in produced:
+                    continue
+                actual = file_state(path)
+                if state is None or actual is None or \
+                        actual['size'] != state['size'] or \
+                        abs(actual['mtime'] - state['mtime']) > 0.001:
+                    conflicts.append(_i("{} was changed after planning")
+                                     .format(path))
+            if dic['op'] in ('copy', 'move'):
+                produced.add(dic['dst'])
+            elif dic['op'] == 'write':
+                produced.add(dic['path'])
+        return conflicts
+
+    def apply(self, executor, report=None):  # -> SyncReport
+        report = report or SyncReport()
+        manifest = SyncManifest.load(self.manifest_path, self.root_dir)
+        manifest.open_journal()
+        engine = CopyEngine(**self.engine)
+        executor.report = report
+        with report.phase('execute'):
+            with ExecutorSuspender(executor):
+                for dic in self.actions:
+                    executor.submit(PLAN_ACTIONS[dic['op']].from_plan(
+                        dic, manifest, engine))
+            executor.shutdown()
+        for dirpath, digest in self.digests.items():
+            if dirpath not in report.failed_keys:
+                manifest.synced(dirpath, digest)
+        manifest.save()
+        manifest.close_journal()
+        return report
 
 # }}}
 # --------------------------------
@@ -645,12 +2463,187 @@ class FileRemoveAction(Action):
 # --------------------------------
 #  Library handlers {{{
 # --------------------------------
+class PlistStreamReader:
+    """Incremental reader for iTunes library plists.
+
+    Each track and playlist is yielded as soon as its <dict> is closed,
+    and the parsed elements are dropped right after, so memory usage does
+    not depend on the size of the document.  Other top level values are
+    collected into `header`.
+    """
+    TRACK = 'track'
+    PLAYLIST = 'playlist'
+    TRACKS_KEY = 'Tracks'
+    PLAYLISTS_KEY = 'Playlists'
+    DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+    def __init__(self, source):
+        """source: path or binary file object"""
+        self.source = source
+        self.header = {}
+
+    def __iter__(self):  # -> iter<(str, str, dict)>
+        values = []    # stack of [container, pending key]
+        elements = []  # stack of opened dict/array elements
+        for ev, elem in ElementTree.iterparse(self.source,
+                                              events=('start', 'end')):
+            tag = elem.tag
+            if ev == 'start':
+                if tag == 'dict':
+                    values.append([{}, None])
+                    elements.append(elem)
+                elif tag == 'array':
+                    values.append([[], None])
+                    elements.append(elem)
+                continue
+            if tag == 'key':
+                values[-1][1] = elem.text or ''
+            elif tag in ('dict', 'array'):
+                value = values.pop()[0]
+                elements.pop()
+                kind = self._item_kind(values)
+                if kind is not None:
+                    yield kind, values[-1][1], value
+                    # Drop already consumed siblings too
+                    elements[-1].clear()
+                elif values:
+                    self._put(values[-1], value)
+                else:
+                    self.header = value
+            elif tag != 'plist':
+                self._put(values[-1], self._convert(tag, elem.text))
+            elem.clear()
+
+    def _item_kind(self, values):
+        if len(values) != 2:
+            return None
+        parent_key = values[0][1]
+        if parent_key == self.TRACKS_KEY:
+            return self.TRACK
+        elif parent_key == self.PLAYLISTS_KEY:
+            return self.PLAYLIST
+
+    def _put(self, frame, value):
+        container, key = frame
+        if isinstance(container, list):
+            container.append(value)
+        else:
+            container[key] = value
+
+    def _convert(self, tag, text):
+        text = text or ''
+        if tag == 'string':
+            return text
+        elif tag == 'integer':
+            return int(text)
+        elif tag == 'real':
+            return float(text)
+        elif tag == 'true':
+            return True
+        elif tag == 'false':
+            return False
+        elif tag == 'date':
+            return datetime.datetime.strptime(text, self.DATE_FORMAT)
+        elif tag == 'data':
+            return base64.b64decode(text)
+        else:
+            raise ValueError(_i("Unknown plist element: {}").format(tag))
+
+
+class LibraryCache:
+    """Snapshot of a parsed library.
+
+    A snapshot is valid only while size, mtime and a hash of the head and
+    tail of the library file are unchanged.
+    """
+    VERSION = 1
+    HASH_BYTES = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+
+    def signature(self, libpath):  # -> tuple or None
+        if not isinstance(libpath, str):
+            return None  # Library read from stream
+        st = os.stat(libpath)
+        return (st.st_size, st.st_mtime_ns,
+                partial_digest(libpath, st.st_size, self.HASH_BYTES))
+
+    def load(self, libpath):  # -> (header, tracks, playlists) or None
+        try:
+            signature = self.signature(libpath)
+            if signature is None:
+                return None
+            with open(self.path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            warn(_i("Library cache {} is broken: {}").format(self.path, e))
+            return None
+        if snapshot.get('version') != self.VERSION or\
+                snapshot.get('signature') != signature:
+            return None
+        return snapshot['header'], snapshot['tracks'], snapshot['playlists']
+
+    def save(self, libpath, header, tracks, playlists):
+        """playlists: list<(dict, list<int>)>"""
+        signature = self.signature(libpath)
+        if signature is None:
+            return
+        snapshot = {
+            'version': self.VERSION,
+            'signature': signature,
+            'header': header,
+            'tracks': tracks,
+            'playlists': playlists,
+        }
+        tmppath = self.path + '.tmp'
+        try:
+            with open(tmppath, 'wb') as f:
+                pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmppath, self.path)
+        except OSError as e:
+            warn(_i("Unable to write library cache {}: {}")
+                 .format(self.path, e))
+
+
 class Library:
-    def __init__(self, pathorfile=None, env=None):
+    def __init__(self, pathorfile=None, env=None, cache=None):
+        """cache: LibraryCache or None"""
         self.file = pathorfile or find_library()
-        self.lib = plistlib.readPlist(self.file)
-        self._create_playlistmap()
         self._track_factory = self._create_track_factory(env)
+        self._load(self.file, cache)
+
+    def _load(self, source, cache=None):
+        if cache is not None:
+            snapshot = cache.load(source)
+            if snapshot is not None:
+                debug("Library loaded from {}".format(cache.path))
+                header, tracks, playlists = snapshot
+                self._index(header, tracks, [
+                    self._build_playlist(dic, track_ids)
+                    for dic, track_ids in playlists])
+                return
+        reader = PlistStreamReader(source)
+        tracks = {}
+        playlists = []
+        for kind, key, dic in reader:
+            if kind == PlistStreamReader.TRACK:
+                tracks[key] = dic
+            else:
+                playlists.append(self._build_playlist(dic))
+        self._index(reader.header, tracks, playlists)
+        if cache is not None:
+            cache.save(source, self.lib, tracks,
+                       [(dict(pl), pl.track_ids) for pl in playlists])
+
+    def _index(self, header, tracks, playlists):
+        self.lib = header
+        self._raw_tracks = tracks
+        self.playlists = playlists
+        self._playlists_map = dict((pl.name, pl) for pl in playlists)
+        self._tracks = {}  # str(track_id) -> EnvTrackAdapter
 
     def _get_path(self):
         try:
@@ -671,27 +2664,19 @@ class Library:
     path = property(fget=_get_path, fset=_set_path)
 
     def track(self, track_id):
-        return self.tracks[str(track_id)]
+        """Tracks are shared between playlists, to resolve them once"""
+        key = str(track_id)
+        try:
+            return self._tracks[key]
+        except KeyError:
+            return self._tracks.setdefault(
+                key, self._build_track(self._raw_tracks[key]))
 
     def playlist_by_name(self, playlist_name):
         return self._playlists_map[playlist_name]
 
-    @cached_property
-    def tracks(self):
-        return WrapDict(self._build_track, self.lib['Tracks'])
-
-    @cached_property
-    def playlists(self):
-        return WrapList(self._build_playlist, self.lib['Playlists'])
-
-    def _create_playlistmap(self):
-        pl_map = {}
-        for playlist in self.playlists:
-            pl_map[playlist.name] = playlist
-        self._playlists_map = pl_map
-
-    def _build_playlist(self, dic):
-        return Playlist(self, dic)
+    def _build_playlist(self, dic, track_ids=None):
+        return Playlist(self, dic, track_ids)
 
     def _build_track(self, dic):
         return self._track_factory(dic)
@@ -699,22 +2684,50 @@ class Library:
     def _create_track_factory(self, env):
         if env is None:
             env = EnvironmentBuilder.create()
-        return (lambda track: EnvTrackAdapter(Track(track), env))
+        return (lambda track: EnvTrackAdapter(track, env))
 
 
-class Track(NameAccessMixin, dict):
-    @cached_property
-    def filename(self):
-        return fixfilename(self.name)
+class Track(NameAccessMixin):
+    """A track of the library.
+
+    Values used for syncing are decoded once into slots.  Others are
+    looked up in the dict from the library file, by attribute or `get`.
+    """
+    __slots__ = ('_dic', 'track_id', 'name', 'artist', 'album', 'location',
+                 'date_modified', 'size', 'total_time', 'is_compilation',
+                 'filename')
+
+    def __init__(self, dic):
+        self._dic = dic
+        self.track_id = dic.get('Track ID')
+        self.name = dic.get('Name', '')
+        self.artist = dic.get('Artist')
+        self.album = dic.get('Album')
+        self.location = dic.get('Location')
+        self.date_modified = dic.get('Date Modified')
+        self.size = dic.get('Size')
+        self.total_time = dic.get('Total Time', 0)
+        self.is_compilation = dic.get('Compilation', False)
+        self.filename = fixfilename(self.name)
+
+    def __getitem__(self, key):
+        return self._dic[key]
+
+    def __contains__(self, key):
+        return key in self._dic
 
     def __str__(self):
         return "{}/{}".format(self.name, self.artist)
 
 
 class Playlist(NameAccessMixin, dict):
-    def __init__(self, lib, dic):
+    def __init__(self, lib, dic, track_ids=None):
         self.lib = lib
         dict.__init__(self, dic)
+        if track_ids is None:
+            track_ids = [item['Track ID']
+                         for item in self.pop('Playlist Items', [])]
+        self.track_ids = track_ids
 
     @cached_property
     def filename(self):
@@ -724,14 +2737,19 @@ class Playlist(NameAccessMixin, dict):
     def tracks(self):
         return list(self._collect_tracks())
 
+    def digest(self, source_state):
+        """Changes when tracks, their order or their files are changed.
+        source_state: callable(track), state of its file in this sync"""
+        h = hashlib.sha1()
+        for track in self.tracks:
+            h.update(repr((track.track_id, str(track.date_modified),
+                           track.location, track.size,
+                           source_state(track))).encode('utf-8'))
+        return h.hexdigest()
+
     def _collect_tracks(self):
-        try:
-            items = self['Playlist Items']
-        except KeyError:
-            return []
-        for track in self['Playlist Items']:
+        for track_id in self.track_ids:
             try:
-                track_id = track['Track ID']
                 yield self.lib.track(track_id)
             except KeyError:
                 warn(_i("Warning: Track ID {0} is not found in library")
@@ -777,6 +2795,11 @@ class EnvironmentBuilder:
 class Environment:
     is_win = False
     is_mac = False
+    media_index_path = None
+
+    @cached_property
+    def media_index(self):
+        return MediaIndex.load(self.itunes_musicdir(), self.media_index_path)
 
     def homedir(self):
         return os.environ['HOME']
@@ -784,6 +2807,9 @@ class Environment:
     def itunes_dir(self):
         return os.path.join(self.homedir(), 'Music', 'iTunes')
 
+    def itunes_musicdir(self):
+        return os.path.join(self.itunes_dir(), 'iTunes Media', 'Music')
+
     def itunes_libfilenames(self):
         return ['iTunes Music Library.xml', 'iTunes Library.xml']
 
@@ -818,55 +2844,131 @@ class Windows(Environment):
         for charcode in range(ord('D'), ord('Z') + 1):
             yield chr(charcode) + ":"
 
+class MediaIndex:
+    """Index of music files in iTunes Media/Music.
+
+    Maps normalized artist, album and title to the path of a file.  It is
+    built by one pass over the directory the first time it is needed, and
+    is stored at `path` to be reused by later runs.  A stored index is
+    built again once when a lookup misses.
+    """
+    VERSION = 1
+    RE_FILENAME = re.compile(r'(?:\d+-)?\d+\s(.+)\.[^.]+$')
+    RE_IGNORED = re.compile(r'[\W_]+')
+
+    def __init__(self, root, path=None, entries=None):
+        self.root = root
+        self.path = path
+        self._entries = entries  # key -> path
+        self._is_fresh = False
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def load(root, path=None):
+        if path is not None:
+            try:
+                with open(path, encoding='utf-8') as f:
+                    dic = json.load(f)
+                if dic.get('version') == MediaIndex.VERSION and\
+                        dic.get('root') == root:
+                    return MediaIndex(root, path, dic['entries'])
+            except FileNotFoundError:
+                pass
+            except (ValueError, KeyError) as e:
+                warn(_i("Media index {} is broken: {}").format(path, e))
+        return MediaIndex(root, path)
+
+    @classmethod
+    def key(cls, artist, album, title):
+        return '/'.join(
+            cls.RE_IGNORED.sub('', unicodedata.normalize('NFC', s).casefold())
+            for s in (artist, album, title))
+
+    def find(self, artist, album, title):  # -> str or None
+        key = self.key(artist, album, title)
+        with self._lock:
+            if self._entries is None:
+                self.build()
+            path = self._entries.get(key)
+            if path is not None and os.path.isfile(path):
+                return path
+            if not self._is_fresh:
+                self.build()
+                return self._entries.get(key)
+
+    def build(self):
+        info(_i("Indexing {}...").format(self.root))
+        entries = {}
+        for artist in self._scandirs(self.root):
+            for album in self._scandirs(artist.path):
+                for entry in os.scandir(album.path):
+                    if not entry.is_file():
+                        continue
+                    matched = self.RE_FILENAME.match(entry.name)
+                    if matched is not None:
+                        title = matched.group(1)
+                    else:
+                        title = os.path.splitext(entry.name)[0]
+                    key = self.key(artist.name, album.name, title)
+                    entries.setdefault(key, entry.path)
+        self._entries = entries
+        self._is_fresh = True
+        self.save()
+
+    def _scandirs(self, path):
+        try:
+            return [e for e in os.scandir(path) if e.is_dir()]
+        except OSError:
+            return []
+
+    def save(self):
+        if self.path is None:
+            return
+        dic = {'version': self.VERSION, 'root': self.root,
+               'entries': self._entries}
+        tmppath = self.path + '.tmp'
+        try:
+            with open(tmppath, 'w', encoding='utf-8') as f:
+                json.dump(dic, f, ensure_ascii=False)
+            os.replace(tmppath, self.path)
+        except OSError as e:
+            warn(_i("Unable to write media index {}: {}")
+                 .format(self.path, e))
+
+
 class TrackFinder:
     def __init__(self, track, env):
         self.track = track
         self.env = env
 
-    def find_artistdir(self):
-        candidate = os.path.join(
-            self.env.itunes_dir(),
-            'iTunes Media',
-            'Music',
-            self.track.artist_dirname)
-        if os.path.isdir(candidate):
-            return candidate
-
-    def find_albumdir(self, artistdir):
-        candidate = os.path.join(
-            artistdir,
-            self.track.album_dirname)
-        if os.path.isdir(candidate):
-            return candidate
-
-    def find_track(self, albumdir):
-        for af in ActualFile.glob(albumdir):
-            if af.track_name == self.track.filename:
-                return af
-
     def find(self):
-        artistdir = self.find_artistdir()
-        if artistdir is not None:
-            albumdir = self.find_albumdir(artistdir)
-            if albumdir is not None:
-                return self.find_track(albumdir)
+        path = self.env.media_index.find(self.track.artist_dirname,
+                                         self.track.album_dirname,
+                                         self.track.filename)
+        if path is not None:
+            return ActualFile(path)
 
 
-class EnvTrackAdapter:
-    def __init__(self, track, env):
-        self.track = track
+class EnvTrackAdapter(Track):
+    """Track whose file is resolved in an Environment"""
+    __slots__ = ('env', '_path', '_stat')
+    UNRESOLVED = object()
+
+    def __init__(self, dic, env):
+        super().__init__(dic)
         self.env = env
+        self._path = self._stat = self.UNRESOLVED
 
     @property
     def artist_dirname(self):
-        if self.track.get('compilation', False):
+        if self.is_compilation:
             return 'Compilations'
         else:
-            return fixfilename(self.artist)
+            return fixfilename(self.artist or '')
 
     @property
     def album_dirname(self):
-        return fixfilename(self.album)
+        return fixfilename(self.album or '')
 
     def _findfile_missing(self):
         finder = TrackFinder(self, self.env)
@@ -875,7 +2977,7 @@ class EnvTrackAdapter:
             warn(_i("Track path of {} was recorded \
 at iTunes library but musicfile is not found at \
 the path, so I guess {} is a correct file.")\
-                 .format(self.track, guessed_file.path))
+                 .format(self, guessed_file.path))
             return guessed_file.path
         else:
             raise IncompleteLibraryError(
@@ -888,42 +2990,50 @@ the path, so I guess {} is a correct file.")\
         if guessed_file is not None:
             warn(_i("Track path of {} was not recorded \
 at iTunes library but I guess {} \
-is a correct file.").format(self.track, guessed_file.path))
+is a correct file.").format(self, guessed_file.path))
             return guessed_file.path
         else:
             raise IncompleteLibraryError(
                 _i("Location of Track {} is not recorded on Library file.")
                 .format(self.name))
 
-    @cached_property
+    @property
     def path(self):
+        if self._path is self.UNRESOLVED:
+            self._path = self._resolve_path()
+        return self._path
+
+    def _resolve_path(self):
+        if self.location is None:
+            # Location has not been recorded on iTunes Library
+            return self._findfile_fallback()
         try:
             path = self.env.url_to_path(self.location)
             if os.path.isfile(path):
                 return path
             else:
                 return self._findfile_missing()
-        except KeyError: # Location has not been recorded on iTunes Library
-            return self._findfile_fallback()
         except Exception as e:
             error(e)
             return None # Fixme: Return any other value
 
+    @property
+    def source_state(self):  # -> (size, mtime_ns) or None
+        """Of the file at the recorded location, without searching for it
+        when it is missing"""
+        if self.location is None:
+            return None
+        try:
+            st = os.stat(self.env.url_to_path(self.location))
+        except (OSError, ValueError):
+            return None
+        return st.st_size, st.st_mtime_ns
 
-    @cached_property
-    def _stat(self):
-        return os.stat(self.path)
-
-    @cached_property
+    @property
     def filesize(self):
+        if self._stat is self.UNRESOLVED:
+            self._stat = os.stat(self.path)
         return self._stat.st_size
-
-    def __getattr__(self, key):
-        return getattr(self.track, key)
-
-    def __str__(self):
-        return "TrackAdapter<Track:{}, Env:{}>"\
-            .format(self.track.name, type(self.env).__name__)
 # }}} # --------------------------------
 
 
@@ -932,8 +3042,26 @@ is a correct file.").format(self.track, guessed_file.path))
 # --------------------------------
 class Device:
     is_fallback = False
+    copy_strategies = ('copy_file_range', 'sendfile', 'readinto')
+    copy_chunk_size = 1024 * 1024
+    preallocate = False
+    fsync_policy = FSYNC_PLAYLIST
+    rate_limits = {}  # RateLimits kind -> MB/s or operations/s
+
+    def copy_engine(self, fsync_policy=None):
+        return CopyEngine(self.copy_strategies, self.copy_chunk_size,
+                          self.preallocate,
+                          fsync_policy or self.fsync_policy)
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.root_dir, MANIFEST_FILENAME)
 
 class Walkman(Device):
+    # FAT on USB mass storage prefers few large writes, and emulated
+    # fallocate would write every file twice.
+    copy_chunk_size = 4 * 1024 * 1024
+
     def __init__(self, device_dir):
         self.root_dir = device_dir
 
@@ -945,12 +3073,20 @@ class Walkman(Device):
     def playlist_dirpath(self, playlist):
         return os.path.join(self.root_dir, 'MUSIC', playlist.filename)
 
+    def pool_dirpath(self):
+        return os.path.join(self.root_dir, 'MUSIC', 'iSyncPool')
+
+    def playlist_filepath(self, playlist):
+        return os.path.join(self.root_dir, 'MUSIC',
+                            playlist.filename + PLAYLIST_EXTENSION)
+
     def __str__(self):
         return 'Walkman at {0}'.format(self.root_dir)
 
 
 class SyncTargetDir(Device):
     is_fallback = True
+    preallocate = True
     def __init__(self, root_dir):
         self.root_dir = root_dir
 
@@ -961,6 +3097,13 @@ class SyncTargetDir(Device):
     def playlist_dirpath(self, playlist):
         return os.path.join(self.root_dir, playlist.filename)
 
+    def pool_dirpath(self):
+        return os.path.join(self.root_dir, 'iSyncPool')
+
+    def playlist_filepath(self, playlist):
+        return os.path.join(self.root_dir,
+                            playlist.filename + PLAYLIST_EXTENSION)
+
     def __str__(self):
         return 'SyncTargetDir at {}'.format(self.root_dir)
 
@@ -994,11 +3137,474 @@ class DeviceLocator:
             yield SyncTargetDir(self.config.target)
 
 
+class SyncManifest:
+    """Record of the files written on a device by isync.
+
+    Directories listed in the manifest are planned from their entries,
+    without listing or stat'ing their files on the device, while their
+    mtimes are those recorded after the last sync.  Each entry holds the
+    track ID, size, mtime and the fingerprint of the source file.
+    Digests of playlists synced into directories are kept with mtimes of
+    the directories, to skip playlists unchanged on both sides.
+
+    Changes are also logged to a SyncJournal while syncing, and those of
+    an interrupted sync are replayed when the manifest is loaded.
+    """
+    VERSION = 1
+
+    def __init__(self, path, root_dir, dirs=None, digests=None,
+                 mtimes=None):
+        self.path = path
+        self.root_dir = root_dir
+        self.dirs = dirs or {}  # relative dir -> {filename -> entry}
+        self.digests = digests or {}  # relative dir -> [digest, mtime_ns]
+        self.mtimes = mtimes or {}  # relative dir -> mtime_ns of entries
+        self._checked = set()  # relative dirs scanned or checked by a sync
+        self.journal = None  # SyncJournal while syncing
+        self.partials = {}  # (reldir, name) -> [offset, fingerprint]
+        self._resuming = set()  # keys of partials copied by this run
+        self._replayed = False
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def load(path, root_dir, rescan=False):
+        manifest = SyncManifest._load(path, root_dir, rescan)
+        manifest.replay(SyncJournal(manifest.journal_path),
+                        changes=not rescan)
+        return manifest
+
+    @staticmethod
+    def _load(path, root_dir, rescan):
+        if rescan:
+            return SyncManifest(path, root_dir)
+        try:
+            with open(path, encoding='utf-8') as f:
+                dic = json.load(f)
+            if dic.get('version') == SyncManifest.VERSION:
+                return SyncManifest(path, root_dir, dic['dirs'],
+                                    dic.get('digests'), dic.get('mtimes'))
+            info(_i("Sync manifest {} is outdated, rescanning device.")
+                 .format(path))
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            warn(_i("Sync manifest {} is broken: {}").format(path, e))
+        return SyncManifest(path, root_dir)
+
+    @property
+    def journal_path(self):
+        return self.path + '.journal'
+
+    def replay(self, journal, changes=True):
+        """Apply changes logged by an interrupted sync.  With changes
+        False, only offsets of unfinished copies are taken."""
+        for entry in journal.entries():
+            op, args = entry[0], entry[1:]
+            try:
+                if op == 'progress':
+                    reldir, name, offset, fingerprint = args
+                    self.partials[reldir, name] = [offset, fingerprint]
+                    continue
+                if not changes:
+                    continue
+                self._replayed = True
+                if op == 'record':
+                    reldir, name, track_id, fingerprint = args
+                    path = self._join(reldir, name)
+                    size = FingerprintCache.size(fingerprint)
+                    if size is None or os.path.getsize(path) == size:
+                        self.record(path, track_id, fingerprint)
+                elif op == 'move':
+                    self.move(self._join(*args[:2]), self._join(*args[2:]))
+                elif op == 'forget':
+                    self.forget(self._join(*args))
+                elif op == 'adopt':
+                    reldir, name, track_id, fingerprint = args
+                    self.adopt(self._join(reldir, name), track_id,
+                               fingerprint)
+                elif op == 'scanned':
+                    reldir, names = args
+                    self.scanned(self._join(reldir, ''),
+                                 [self._join(reldir, n) for n in names])
+                elif op == 'mtime':
+                    reldir, mtime = args
+                    self.mtimes[reldir] = mtime
+            except (OSError, ValueError, TypeError) as e:
+                debug("Skipped journal entry {}: {}".format(entry, e))
+        if self._replayed:
+            info(_i("Resuming an interrupted sync of {}").format(self.root_dir))
+
+    def open_journal(self):
+        """Persist replayed changes, and log changes from now on"""
+        if self._replayed:
+            self.save()
+            self._replayed = False
+        journal = SyncJournal(self.journal_path)
+        try:
+            journal.open(self._progress_entries(self.partials))
+        except OSError as e:
+            warn(_i("Unable to write sync journal {}: {}")
+                 .format(journal.path, e))
+            return
+        self.journal = journal
+
+    def close_journal(self):
+        """Called after saving, to keep only offsets of unfinished copies.
+        Temporary files of copies not retried by this sync are removed."""
+        if self.journal is None:
+            return
+        with self._lock:
+            keep = {}
+            for key, partial in self.partials.items():
+                if key in self._resuming:
+                    keep[key] = partial
+                else:
+                    try:
+                        os.remove(CopyEngine.part_path(self._join(*key)))
+                    except OSError:
+                        pass
+            self.partials = keep
+        self.journal.close(self._progress_entries(keep))
+        self.journal = None
+
+    def _progress_entries(self, partials):
+        return [['progress', reldir, name, offset, fingerprint]
+                for (reldir, name), (offset, fingerprint)
+                in partials.items()]
+
+    def _log(self, *entry, durable=False):
+        if self.journal is not None:
+            self.journal.append(list(entry), durable)
+
+    def _join(self, reldir, name):
+        return os.path.join(self.root_dir, reldir, name)
+
+    def save(self):
+        with self._lock:
+            dic = {'version': self.VERSION, 'dirs': self.dirs,
+                   'digests': self.digests, 'mtimes': self.mtimes}
+            tmppath = self.path + '.tmp'
+            try:
+                with open(tmppath, 'w', encoding='utf-8') as f:
+                    json.dump(dic, f, ensure_ascii=False)
+                os.replace(tmppath, self.path)
+            except OSError as e:
+                warn(_i("Unable to write sync manifest {}: {}")
+                     .format(self.path, e))
+
+    def _split(self, path):
+        relpath = os.path.relpath(path, self.root_dir).replace(os.sep, '/')
+        reldir, _, name = unicodedata.normalize('NFC', relpath)\
+            .rpartition('/')
+        return reldir, name
+
+    def _reldir(self, dirpath):
+        reldir = os.path.relpath(dirpath, self.root_dir)
+        if reldir == os.curdir:
+            return ''
+        return unicodedata.normalize('NFC', reldir.replace(os.sep, '/'))
+
+    def knows_dir(self, dirpath):
+        """Whether entries of dirpath can be used instead of listing it,
+        since it was not modified after they were recorded"""
+        reldir = self._reldir(dirpath)
+        with self._lock:
+            if reldir not in self.dirs:
+                return False
+            recorded = self.mtimes.get(reldir)
+        try:
+            if os.stat(dirpath).st_mtime_ns != recorded:
+                return False
+        except OSError:
+            return False
+        with self._lock:
+            self._checked.add(reldir)
+        return True
+
+    def update_mtimes(self):
+        """Record mtimes of directories scanned or checked by this sync,
+        after its actions are executed"""
+        with self._lock:
+            reldirs = list(self._checked)
+        for reldir in reldirs:
+            try:
+                mtime = os.stat(self._join(reldir, '')).st_mtime_ns
+            except OSError:
+                continue
+            with self._lock:
+                self.mtimes[reldir] = mtime
+                self._log('mtime', reldir, mtime)
+
+    def entries(self):  # -> list<(reldir, list<(name, dict)>)>
+        with self._lock:
+            return [(reldir, list(entries.items()))
+                    for reldir, entries in self.dirs.items()]
+
+    def files_in(self, dirpath):  # -> iter<(str, dict)>
+        with self._lock:
+            entries = list(self.dirs.get(self._reldir(dirpath), {}).items())
+        for name, entry in entries:
+            yield os.path.join(dirpath, name), entry
+
+    def entry(self, path):  # -> dict or None
+        reldir, name = self._split(path)
+        with self._lock:
+            return self.dirs.get(reldir, {}).get(name)
+
+    def scanned(self, dirpath, paths):
+        """Replace entries of dirpath by actually existing files"""
+        reldir = self._reldir(dirpath)
+        with self._lock:
+            old = self.dirs.get(reldir, {})
+            new = {}
+            for path in paths:
+                name = self._split(path)[1]
+                if not name.startswith(CopyEngine.PART_PREFIX):
+                    new[name] = old.get(name, {})
+            self.dirs[reldir] = new
+            self._checked.add(reldir)
+            self._log('scanned', reldir, list(new))
+
+    def record(self, path, track_id=None, fingerprint=None):
+        st = os.stat(path)
+        reldir, name = self._split(path)
+        with self._lock:
+            self.dirs.setdefault(reldir, {})[name] = {
+                'track_id': track_id,
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'fingerprint': fingerprint,
+            }
+            self.partials.pop((reldir, name), None)
+            self._resuming.discard((reldir, name))
+            self._log('record', reldir, name, track_id, fingerprint)
+
+    def move(self, src, dst):
+        srcdir, srcname = self._split(src)
+        dstdir, dstname = self._split(dst)
+        with self._lock:
+            entries = self.dirs.get(srcdir, {})
+            if srcname not in entries and \
+                    dstname in self.dirs.get(dstdir, {}):
+                return  # Replayed twice
+            entry = entries.pop(srcname, {})
+            self.dirs.setdefault(dstdir, {})[dstname] = entry
+            self._log('move', srcdir, srcname, dstdir, dstname)
+
+    def forget(self, path):
+        reldir, name = self._split(path)
+        with self._lock:
+            self.dirs.get(reldir, {}).pop(name, None)
+            self._log('forget', reldir, name)
+
+    def resume_offset(self, path, fingerprint):  # -> int
+        """Offset to which an unfinished copy of the same source is
+        durable, or 0"""
+        key = self._split(path)
+        with self._lock:
+            partial = self.partials.get(key)
+            if fingerprint is None or partial is None or \
+                    partial[1] != fingerprint:
+                return 0
+            self._resuming.add(key)
+            return partial[0]
+
+    def progress(self, path, offset, fingerprint):
+        reldir, name = self._split(path)
+        with self._lock:
+            self.partials[reldir, name] = [offset, fingerprint]
+            self._resuming.add((reldir, name))
+            self._log('progress', reldir, name, offset, fingerprint,
+                      durable=True)
+
+    def is_unchanged(self, dirpath, digest):
+        with self._lock:
+            recorded = self.digests.get(self._reldir(dirpath))
+        if recorded is None or recorded[0] != digest:
+            return False
+        try:
+            return os.stat(dirpath).st_mtime_ns == recorded[1]
+        except OSError:
+            return False
+
+    def synced(self, dirpath, digest):
+        """Record digest of the playlist in dirpath, after syncing it"""
+        try:
+            mtime = os.stat(dirpath).st_mtime_ns
+        except OSError:
+            return
+        with self._lock:
+            self.digests[self._reldir(dirpath)] = [digest, mtime]
+
+    def adopt(self, path, track_id, fingerprint):
+        """Accept an existing file as a copy of the source"""
+        reldir, name = self._split(path)
+        with self._lock:
+            entry = self.dirs.setdefault(reldir, {}).setdefault(name, {})
+            entry['track_id'] = track_id
+            entry['fingerprint'] = fingerprint
+            self._log('adopt', reldir, name, track_id, fingerprint)
+
+
+class SyncJournal:
+    """Append-only log of changes of a SyncManifest, kept on the device.
+
+    Each line is a JSON list of an operation and its arguments.  Lines are
+    flushed as they are written, and fsync'ed only for offsets of copies,
+    so a change may be lost on power failure, but never half applied.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def entries(self):  # -> iter<list>
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        return  # Torn write at the end
+        except FileNotFoundError:
+            pass
+
+    def open(self, entries=()):
+        """Start a new journal, holding entries carried over"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._rewrite(entries)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def append(self, entry, durable=False):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._file.flush()
+            if durable:
+                os.fsync(self._file.fileno())
+
+    def close(self, entries=()):
+        """Close, and leave only entries needed by the next sync"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        if entries:
+            self._rewrite(entries)
+        else:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def _rewrite(self, entries):
+        tmppath = self.path + '.tmp'
+        with open(tmppath, 'w', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmppath, self.path)
+
+
+class FingerprintCache:
+    """Fingerprints of source files, kept on the host.
+
+    A fingerprint is the size and a hash of the head and tail of a file,
+    or its size and mtime when hashing is disabled.  Hashes are computed
+    again only when size or mtime of the file changed.  Digests of whole
+    files, used to verify copies, are kept the same way.
+    """
+    HASH_BYTES = 64 * 1024
+
+    def __init__(self, path=None, use_hash=True, entries=None, digests=None):
+        self.path = path
+        self.use_hash = use_hash
+        self._entries = entries or {}  # path -> [size, mtime_ns, fp]
+        self._digests = digests or {}  # path -> [size, mtime_ns, digest]
+        self._lock = threading.RLock()
+        self._is_dirty = False
+
+    @staticmethod
+    def load(path, use_hash=True):
+        try:
+            with open(path, encoding='utf-8') as f:
+                dic = json.load(f)
+            if dic.get('use_hash') == use_hash:
+                return FingerprintCache(path, use_hash, dic['entries'],
+                                        dic.get('digests'))
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            warn(_i("Fingerprint cache {} is broken: {}").format(path, e))
+        return FingerprintCache(path, use_hash)
+
+    @staticmethod
+    def size(fingerprint):  # -> int or None
+        """Size of the file recorded in fingerprint"""
+        try:
+            return int(fingerprint.partition(':')[0])
+        except (AttributeError, ValueError):
+            return None
+
+    def fingerprint(self, path):
+        st = os.stat(path)
+        with self._lock:
+            cached = self._entries.get(path)
+        if cached is not None and cached[0] == st.st_size and\
+                cached[1] == st.st_mtime_ns:
+            return cached[2]
+        if self.use_hash:
+            digest = partial_digest(path, st.st_size, self.HASH_BYTES)
+        else:
+            digest = str(st.st_mtime_ns)
+        fp = '{}:{}'.format(st.st_size, digest)
+        with self._lock:
+            self._entries[path] = [st.st_size, st.st_mtime_ns, fp]
+            self._is_dirty = True
+        return fp
+
+    def digest(self, path):
+        """file_digest of path, hashed again only when it changed"""
+        st = os.stat(path)
+        with self._lock:
+            cached = self._digests.get(path)
+        if cached is not None and cached[0] == st.st_size and\
+                cached[1] == st.st_mtime_ns:
+            return cached[2]
+        digest = file_digest(path)
+        with self._lock:
+            self._digests[path] = [st.st_size, st.st_mtime_ns, digest]
+            self._is_dirty = True
+        return digest
+
+    def save(self):
+        if self.path is None or not self._is_dirty:
+            return
+        with self._lock:
+            dic = {'use_hash': self.use_hash, 'entries': self._entries,
+                   'digests': self._digests}
+            tmppath = self.path + '.tmp'
+            try:
+                with open(tmppath, 'w', encoding='utf-8') as f:
+                    json.dump(dic, f, ensure_ascii=False)
+                os.replace(tmppath, self.path)
+                self._is_dirty = False
+            except OSError as e:
+                warn(_i("Unable to write fingerprint cache {}: {}")
+                     .format(self.path, e))
+
+
 class ActualFile(WorkerMixin):
     RE_FILENAME = re.compile(r'(\d+)\s(.+)\.({})'.format('|'.join(MUSICFILE_EXTENSIONS)))
-    def __init__(self, path):
-        """path: indexed file path"""
+    def __init__(self, path, entry=None, manifest=None, engine=None):
+        """path: indexed file path,
+        entry: record of the file in manifest, if it is known"""
         self.path = unicodedata.normalize('NFC', path)
+        self.entry = entry
+        self.manifest = manifest
+        self.engine = engine
 
     @staticmethod
     def glob(dirpath):
@@ -1009,17 +3615,42 @@ class ActualFile(WorkerMixin):
     def _stat(self):
         return os.stat(self.path)
 
+    @property
+    def exists(self):
+        if self.entry is not None:
+            return True
+        return os.path.exists(self.path)
+
     @property
     def last_modified(self):
+        if self.entry is not None and self.entry.get('mtime') is not None:
+            return datetime.datetime.fromtimestamp(self.entry['mtime'])
         return datetime.datetime.fromtimestamp(self._stat.st_mtime)
 
-    def copy_track(self, track):
-        self.submit(FileCopyAction(track.path, self.path))
+    @property
+    def size(self):
+        if self.entry is not None and self.entry.get('size') is not None:
+            return self.entry['size']
+        return self._stat.st_size
 
-    def update_track(self, track):
-        if not os.path.exists(self.path) or\
-                track.date_modified > self.last_modified:
-            self.copy_track(track)
+    def is_outdated(self, track, fingerprint):
+        """Whether contents differ from the source of the track"""
+        if self.entry is not None and self.entry.get('fingerprint'):
+            return self.entry['fingerprint'] != fingerprint
+        # Unknown origin, same size is regarded as same contents
+        if self.size != track.filesize:
+            return True
+        if self.manifest is not None:
+            self.manifest.adopt(self.path, track.track_id, fingerprint)
+        return False
+
+    def copy_track(self, track, fingerprint=None):
+        self.submit(FileCopyAction(track.path, self.path, self.manifest,
+                                   track.track_id, fingerprint, self.engine))
+
+    def update_track(self, track, fingerprint):
+        if not self.exists or self.is_outdated(track, fingerprint):
+            self.copy_track(track, fingerprint)
             return WillBeCopied(track, self.path)
         else:
             return NothingToDo(track)
@@ -1030,12 +3661,24 @@ class ActualFile(WorkerMixin):
 
     @cached_property
     def _matched(self):
-        return self.RE_FILENAME.match(self.filename)
+        name = self.filename
+        if name.startswith(SyncDirectory.TEMP_PREFIX):
+            # Left by an interrupted rename, which is done again
+            name = name[len(SyncDirectory.TEMP_PREFIX):]
+        return self.RE_FILENAME.match(name)
+
+    @property
+    def is_track(self):
+        return self._matched is not None
 
     @property
     def track_number(self):
         return int(self._matched.group(1))
 
+    @property
+    def index_digits(self):
+        return len(self._matched.group(1))
+
     @property
     def track_name(self):
         return self._matched.group(2)
@@ -1086,6 +3729,16 @@ class WillBeDeleted(SyncPlan):
                 .format(self.path)
 
 
+class WillBeWritten(SyncPlan):
+    def __init__(self, playlist, path):
+        self.playlist = playlist
+        self.path = path
+
+    def __str__(self):
+        return _i("Playlist '{}' will be written to {}")\
+                .format(self.playlist.name, self.path)
+
+
 class NothingToDo(SyncPlan):
     importance = logging.DEBUG
 
@@ -1112,22 +3765,47 @@ class AnErrorOccurrd(SyncPlan):
 
 class SyncDirectory(WorkerMixin):
     RE_PAT = re.compile(r'\d+\s(.+)\.({})'.format(MUSICFILE_EXTENSIONS))
+    TEMP_PREFIX = '.isync-tmp '
 
-    def __init__(self, path, expected_files_count,
-                 force_write=False, dryrun=False):
+    def __init__(self, path, force_write=False, dryrun=False, manifest=None,
+                 fingerprints=None, engine=None):
         self.path = path
+        self.manifest = manifest
+        self.engine = engine or CopyEngine.default
+        self.fingerprints = fingerprints or FingerprintCache()
+        self.is_indexed = manifest is not None and manifest.knows_dir(path)
         self.files_map = self.collect_files()
         self.force_write = force_write
-        self.index_digits = int(math.log10(expected_files_count)) + 1
+        self.index_digits = None  # Width chosen by RenumberPlanner
+        self._moves = []  # (oldname, newname)
 
-    def collect_files(self):  # -> dict<str, str>
-        if not os.path.isdir(self.path):
-            os.makedirs(self.path)
+    def collect_files(self):  # -> dict<str, ActualFile>
+        if self.is_indexed:
+            files = [self.create_actual_file(path, entry)
+                     for path, entry in self.manifest.files_in(self.path)]
+        else:
+            files = []  # A missing directory is created by its first copy
+            if os.path.isdir(self.path):
+                files = [self.create_actual_file(af.path)
+                         for af in ActualFile.glob(self.path)]
+            if self.manifest is not None:
+                self.manifest.scanned(self.path, [af.path for af in files])
         fs = {}
-        for af in ActualFile.glob(self.path):
-            fs[af.track_name] = af
+        for af in files:
+            if af.is_track:
+                fs[af.track_name] = af
         return fs
 
+    def has_track(self, track):
+        return track.filename in self.files_map
+
+    def current_number(self, track):  # -> (int, int) or None
+        try:
+            af = self.files_map[track.filename]
+            return af.track_number, af.index_digits
+        except KeyError:
+            return None
+
     def prune_tracks(self, tracks):  # generator of SyncPlan
         fm = {}  # Track.filename -> Track
         for track in tracks:
@@ -1137,15 +3815,18 @@ class SyncDirectory(WorkerMixin):
                 yield self.remove_track(af.path)
 
     def remove_track(self, path):
-        self.submit(FileRemoveAction(path))
+        self.submit(FileRemoveAction(path, self.manifest))
         return WillBeDeleted(path)
 
     def update_track_at(self, track, pos):
         try:
-            if track.filename in self.files_map:
-                return self.update_filename(track, pos)
-            else:
+            if track.filename not in self.files_map:
                 return self.copy_new(track, pos)
+            elif self.files_map[track.filename].is_outdated(
+                    track, self.fingerprint(track)):
+                return self.replace_file(track, pos)
+            else:
+                return self.update_filename(track, pos)
         except IncompleteLibraryError as ex:
             error(ex)
             error(_i('We could not sync {} because it has incomplete \
@@ -1163,30 +3844,518 @@ information').format(track.name))
         name = self.actual_name(track, pos)
         return os.path.join(self.path, name)
 
+    def fingerprint(self, track):
+        if track.path is None:
+            raise IncompleteLibraryError()
+        return self.fingerprints.fingerprint(track.path)
+
     def update_filename(self, track, pos):
+        """Renames are deferred until flush_moves is called"""
         newname = self.actual_name(track, pos)
         oldname = self.files_map[track.filename].filename
         if newname != oldname:
-            self.move_file(oldname, newname)
+            self._moves.append((oldname, newname))
             return WillBeRenamed(track, oldname, newname)
         else:
             return NothingToDo(track)
 
+    def flush_moves(self):
+        """Submit deferred renames.
+
+        A rename whose destination is still held by another renamed file
+        goes through a temporary name, after all other renames.
+        """
+        sources = set(oldname for oldname, _ in self._moves)
+        staged = [(o, n) for o, n in self._moves if n in sources]
+        direct = [(o, n) for o, n in self._moves if n not in sources]
+        for oldname, newname in staged:
+            self.move_file(oldname, self.TEMP_PREFIX + newname)
+        for oldname, newname in direct:
+            self.move_file(oldname, newname)
+        for _, newname in staged:
+            self.move_file(self.TEMP_PREFIX + newname, newname)
+        self._moves = []
+
     def move_file(self, oldname, newname):
         oldpath = os.path.join(self.path, oldname)
         newpath = os.path.join(self.path, newname)
         self.exec_move(oldpath, newpath)
 
     def exec_move(self, src, dst):
-        self.submit(FileMoveAction(src, dst))
+        self.submit(FileMoveAction(src, dst, self.manifest))
 
     def copy_new(self, track, pos):
         path = self.actual_path(track, pos)
-        actual_file = ActualFile(path)
-        return actual_file.update_track(track)
+        actual_file = self.create_actual_file(path)
+        if self.is_indexed:  # Every file in this directory is in files_map
+            actual_file.copy_track(track, self.fingerprint(track))
+            return WillBeCopied(track, path)
+        return actual_file.update_track(track, self.fingerprint(track))
+
+    def replace_file(self, track, pos):
+        oldpath = self.files_map[track.filename].path
+        newpath = self.actual_path(track, pos)
+        self.create_actual_file(newpath).copy_track(
+            track, self.fingerprint(track))
+        if oldpath != newpath:
+            self.remove_track(oldpath)
+        return WillBeCopied(track, newpath)
+
+    def create_actual_file(self, path, entry=None):
+        return ActualFile(path, entry, self.manifest, self.engine)
+
+    def flush(self):
+        """Make copies into this directory durable once they are done"""
+        if self.engine.fsync_policy == FSYNC_PLAYLIST:
+            self.submit(FlushAction(self.engine, self.path))
+
+
+class PoolSyncer(WorkerMixin):
+    """Syncs playlists into a pool of tracks shared by all of them.
+
+    Each track is copied once, named after the fingerprint of its
+    contents, and each playlist is written as an M3U8 file referring to
+    the pool.  Pooled files no target playlist refers to are removed.
+    While some tracks cannot be resolved, e.g. their drive is not
+    mounted, nothing is removed and playlists with such tracks are kept
+    as they are, since their files in the pool are not known.
+    """
+    NAME_LENGTH = 20
+
+    def __init__(self, playlists, device, manifest=None, fingerprints=None,
+                 engine=None):
+        self.playlists = playlists
+        self.device = device
+        self.manifest = manifest
+        self.fingerprints = fingerprints or FingerprintCache()
+        self.engine = engine or CopyEngine.default
+        self.path = device.pool_dirpath()
+
+    def sync(self):  # generator of SyncPlan
+        existing = self.collect_files()
+        refs = collections.OrderedDict()  # pool name -> track
+        contents = []
+        is_complete = True
+        for playlist in self.playlists:
+            items = []  # (track, pool name), None if a track is unresolved
+            for track in playlist.tracks:
+                try:
+                    name = self.pool_name(track)
+                except (IncompleteLibraryError, OSError) as ex:
+                    error(_i('We could not sync {} because it has \
+incomplete information').format(track.name))
+                    yield AnErrorOccurrd(track, ex)
+                    items = None
+                    is_complete = False
+                    continue
+                refs.setdefault(name, track)
+                if items is not None:
+                    items.append((track, name))
+            contents.append((playlist, items))
+        if is_complete:
+            for name in sorted(existing - set(refs)):
+                yield self.remove_file(os.path.join(self.path, name))
+        else:
+            warn(_i("Unused files in the pool are kept, since some tracks \
+could not be resolved."))
+        for name, track in refs.items():
+            if name in existing:
+                yield NothingToDo(track)
+            else:
+                yield self.copy_track(track, name)
+        if self.engine.fsync_policy == FSYNC_PLAYLIST:
+            self.submit(FlushAction(self.engine, self.path))
+        for playlist, items in contents:
+            if items is not None:
+                yield from self.write_playlist(playlist, items)
+        yield from self.prune_playlists()
+
+    def collect_files(self):  # -> set<str>
+        if self.manifest is not None and self.manifest.knows_dir(self.path):
+            return set(os.path.basename(path) for path, _
+                       in self.manifest.files_in(self.path))
+        names = []  # A missing pool is created by its first copy
+        if os.path.isdir(self.path):
+            names = [n for n in os.listdir(self.path)
+                     if not n.startswith(CopyEngine.PART_PREFIX)]
+        if self.manifest is not None:
+            self.manifest.scanned(
+                self.path, [os.path.join(self.path, n) for n in names])
+        return set(unicodedata.normalize('NFC', n) for n in names)
+
+    def pool_name(self, track):
+        if track.path is None:
+            raise IncompleteLibraryError()
+        fingerprint = self.fingerprints.fingerprint(track.path)
+        _, extension = os.path.splitext(track.path)
+        digest = hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()
+        return digest[:self.NAME_LENGTH] + extension.lower()
+
+    def copy_track(self, track, name):
+        path = os.path.join(self.path, name)
+        self.submit(FileCopyAction(
+            track.path, path, self.manifest, track.track_id,
+            self.fingerprints.fingerprint(track.path), self.engine))
+        return WillBeCopied(track, path)
+
+    def remove_file(self, path):
+        self.submit(FileRemoveAction(path, self.manifest))
+        return WillBeDeleted(path)
+
+    def playlist_text(self, path, items):
+        lines = ['#EXTM3U']
+        basedir = os.path.dirname(path)
+        for track, name in items:
+            seconds = track.total_time // 1000
+            lines.append('#EXTINF:{},{} - {}'.format(
+                seconds, track.get('artist', ''), track.name))
+            lines.append(os.path.relpath(os.path.join(self.path, name),
+                                         basedir))
+        return '\n'.join(lines) + '\n'
+
+    def write_playlist(self, playlist, items):  # generator of SyncPlan
+        path = self.device.playlist_filepath(playlist)
+        text = self.playlist_text(path, items)
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        entry = self.manifest and self.manifest.entry(path)
+        if entry and entry.get('fingerprint') == digest:
+            return
+        self.submit(FileWriteAction(path, text, self.manifest, digest))
+        yield WillBeWritten(playlist, path)
+
+    def prune_playlists(self):  # generator of SyncPlan
+        """Remove playlist files written for playlists not synced now"""
+        if self.manifest is None:
+            return
+        paths = set(unicodedata.normalize(
+            'NFC', self.device.playlist_filepath(pl))
+            for pl in self.playlists)
+        for dirpath in set(os.path.dirname(p) for p in paths):
+            for path, entry in list(self.manifest.files_in(dirpath)):
+                if path.endswith(PLAYLIST_EXTENSION) and path not in paths:
+                    yield self.remove_file(path)
+
+
+class SyncReport:
+    """Timings and counts of a sync.
+
+    Phases are wall time, summed over threads for nested phases which
+    run on several threads.
+    """
+    SLOWEST_COUNT = 10
+    profiler = None  # PhaseProfiler
+
+    def __init__(self, device=None):
+        self.device = device
+        self.phases = collections.OrderedDict()  # name -> seconds
+        self.plans = collections.Counter()  # SyncPlan type -> count
+        self.actions = collections.Counter()  # Action type -> count
+        self.copied_bytes = 0
+        self._slowest = []  # heap of (seconds, seq, str(action))
+        self.failed_keys = set()  # ordering keys of failed actions
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name, profile=False):
+        """profile: profile it with `profiler`, which is only used for
+        phases which do not run in parallel with each other"""
+        started = time.perf_counter()
+        try:
+            if profile and self.profiler is not None:
+                with self.profiler.phase(name):
+                    yield
+            else:
+                yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count_plans(self, plans):
+        with self._lock:
+            self.plans.update(type(plan).__name__ for plan in plans)
+
+    def record_action(self, action, seconds):
+        action = getattr(action, '__self__', action)  # dryrun of DryExecutor
+        with self._lock:
+            self.actions[type(action).__name__] += 1
+            self.copied_bytes += getattr(action, 'copied_bytes', 0)
+            item = (seconds, sum(self.actions.values()), str(action))
+            if len(self._slowest) < self.SLOWEST_COUNT:
+                heapq.heappush(self._slowest, item)
+            else:
+                heapq.heappushpop(self._slowest, item)
+
+    def record_failure(self, action):
+        with self._lock:
+            self.failed_keys.add(getattr(action, 'ordering_key', None))
+
+    @property
+    def slowest(self):  # -> list<(float, str)>
+        return [(sec, name) for sec, _, name
+                in sorted(self._slowest, reverse=True)]
+
+    @property
+    def throughput(self):  # MB/s while executing actions
+        seconds = self.phases.get('execute', 0.0)
+        if seconds <= 0:
+            return 0.0
+        return self.copied_bytes / seconds / 1000000
+
+    def to_dict(self):
+        return {
+            'device': str(self.device),
+            'phases': dict(self.phases),
+            'plans': dict(self.plans),
+            'actions': dict(self.actions),
+            'copied_bytes': self.copied_bytes,
+            'throughput_mbps': self.throughput,
+            'slowest': [{'seconds': sec, 'action': name}
+                        for sec, name in self.slowest],
+        }
+
+    def format(self):
+        lines = [_i("Sync report for {}").format(self.device)]
+        for name, seconds in self.phases.items():
+            lines.append("  {:<12}{:10.3f} s".format(name, seconds))
+        for name, count in sorted(self.plans.items()):
+            lines.append("  {:<24}{:8d}".format(name, count))
+        lines.append(_i("  Copied {:.1f} MB, {:.2f} MB/s").format(
+            self.copied_bytes / 1000000, self.throughput))
+        for seconds, name in self.slowest:
+            lines.append("  {:8.3f} s {}".format(seconds, name))
+        return '\n'.join(lines)
+
+
+class Progress(collections.namedtuple('Progress', [
+        'actions_done', 'actions_total', 'bytes_done', 'bytes_total',
+        'current', 'errors', 'elapsed'])):
+    """Snapshot delivered by ProgressBus.  errors are (action, exception)
+    which failed since the previous snapshot."""
+    __slots__ = ()
+
+    @property
+    def eta(self):  # -> seconds or None
+        if self.bytes_total > 0:
+            done, total = self.bytes_done, self.bytes_total
+        else:
+            done, total = self.actions_done, self.actions_total
+        if done <= 0 or self.elapsed <= 0:
+            return None
+        return max(0.0, (total - done) * self.elapsed / done)
+
+
+class ProgressBus:
+    """Progress of executing actions, for UIs and loggers.
+
+    Workers only update counters.  A dispatcher thread delivers a
+    Progress snapshot to subscribers at most every `interval` seconds,
+    and once more on stop, so subscribers never run in workers.
+    Subscribers are weakly referenced, and dropped when collected.
+    """
+    INTERVAL = 0.5
+
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self._subscribers = []  # weakref of callable(Progress)
+        self._actions = [0, 0]  # done, total
+        self._bytes = [0, 0]  # done, total
+        self._current = None  # Action started last
+        self._errors = []  # Not delivered yet
+        self._dirty = False
+        self._started = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
 
-    def create_actual_file(self, path):
-        return ActualFile(path)
+    def subscribe(self, f):
+        if inspect.ismethod(f):
+            ref = weakref.WeakMethod(f)
+        else:
+            ref = weakref.ref(f)
+        with self._lock:
+            self._subscribers.append(ref)
+
+    def unsubscribe(self, f):
+        with self._lock:
+            self._subscribers = [ref for ref in self._subscribers
+                                 if ref() is not None and ref() != f]
+
+    def expect(self, action):
+        size = getattr(action, 'expected_bytes', 0)
+        with self._lock:
+            self._actions[1] += 1
+            self._bytes[1] += size
+            self._dirty = True
+
+    def started(self, action):
+        self._current = action
+
+    def completed(self, action):
+        with self._lock:
+            self._actions[0] += 1
+            self._dirty = True
+
+    def failed(self, action, exception):
+        with self._lock:
+            self._errors.append((action, exception))
+
+    def copied(self, size):
+        with self._lock:
+            self._bytes[0] += size
+            self._dirty = True
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._dispatch_loop,
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+        self.dispatch()
+
+    def _dispatch_loop(self):
+        while not self._stopped.wait(self.interval):
+            if self._dirty or self._errors:
+                self.dispatch()
+
+    def snapshot(self):  # -> Progress
+        with self._lock:
+            errors, self._errors = self._errors, []
+            self._dirty = False
+            elapsed = 0.0
+            if self._started is not None:
+                elapsed = time.perf_counter() - self._started
+            current = self._current
+            return Progress(self._actions[0], self._actions[1],
+                            self._bytes[0], self._bytes[1],
+                            getattr(current, 'short_repr', current),
+                            errors, elapsed)
+
+    def dispatch(self):
+        progress = self.snapshot()
+        with self._lock:
+            refs = list(self._subscribers)
+        for ref in refs:
+            f = ref()
+            if f is None:
+                continue
+            try:
+                f(progress)
+            except Exception as e:
+                warn(_i("Progress subscriber failed: {}").format(e))
+        with self._lock:
+            self._subscribers = [ref for ref in self._subscribers
+                                 if ref() is not None]
+
+
+def log_progress(progress):
+    eta = progress.eta
+    info(_i("{}/{} actions, {:.1f}/{:.1f} MB, {} left").format(
+        progress.actions_done, progress.actions_total,
+        progress.bytes_done / 1000000, progress.bytes_total / 1000000,
+        '?' if eta is None else datetime.timedelta(seconds=int(eta))))
+
+
+class PhaseProfiler:
+    """Profiles phases of a sync with cProfile and tracemalloc.
+
+    A phase is written into dirpath as <phase>.pstats, merged over the
+    threads it ran on, and <phase>-memory.txt listing its largest
+    allocations still alive at its end.  Before Python 3.12, cProfile
+    only sees the thread it is enabled on, so workers profile themselves
+    by `thread`.
+    """
+    TOP_ALLOCATIONS = 30
+    PER_THREAD = sys.version_info < (3, 12)
+
+    def __init__(self, dirpath, cpu=True, memory=False):
+        self.dirpath = dirpath
+        self.cpu = cpu
+        self.memory = memory
+        self._profiles = {}  # (phase, thread id) -> cProfile.Profile
+        self._active = set()  # Thread ids running a profile
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if self.memory:
+            tracemalloc.start()
+        try:
+            with self.thread(name, per_thread=False):
+                yield
+        finally:
+            if self.memory:
+                self._write_memory(name, tracemalloc.take_snapshot(),
+                                   tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            if self.cpu:
+                self._write_stats(name)
+
+    @contextlib.contextmanager
+    def thread(self, name, per_thread=True):
+        """Profile name on this thread, unless it is profiled already"""
+        ident = threading.get_ident()
+        with self._lock:
+            skip = not self.cpu or ident in self._active or \
+                (per_thread and not self.PER_THREAD)
+            if not skip:
+                profile = self._profiles.setdefault((name, ident),
+                                                    cProfile.Profile())
+                self._active.add(ident)
+        if skip:
+            yield
+            return
+        try:
+            profile.enable()
+        except ValueError as e:  # Another profiler is running
+            debug(e)
+            skip = True
+        try:
+            yield
+        finally:
+            if not skip:
+                profile.disable()
+            with self._lock:
+                self._active.discard(ident)
+
+    def _write_stats(self, name):
+        with self._lock:
+            profiles = [self._profiles.pop(key) for key in list(self._profiles)
+                        if key[0] == name]
+        stats = None
+        for profile in profiles:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+            except TypeError:
+                pass  # Never enabled
+        if stats is not None:
+            stats.dump_stats(self._path(name + '.pstats'))
+
+    def _write_memory(self, name, snapshot, peak):
+        stats = snapshot.statistics('lineno')
+        with open(self._path(name + '-memory.txt'), 'w') as f:
+            f.write("Peak {:.1f} KiB, {:.1f} KiB alive in {} blocks\n".format(
+                peak / 1024, sum(stat.size for stat in stats) / 1024,
+                sum(stat.count for stat in stats)))
+            for stat in stats[:self.TOP_ALLOCATIONS]:
+                f.write("{}\n".format(stat))
+
+    def _path(self, filename):
+        os.makedirs(self.dirpath, exist_ok=True)
+        path = os.path.join(self.dirpath, filename)
+        info(_i("Writing profile {}").format(path))
+        return path
 
 
 class SyncerManager(WorkerMixin):
@@ -1199,26 +4368,217 @@ class SyncerManager(WorkerMixin):
 
 
 class LibrarySyncer(WorkerMixin):
-    def __init__(self, library, config, device):
+    is_dry = False
+
+    def __init__(self, library, config, device, report=None,
+                 fingerprints=None, progress=None, rate_limits=None):
+        """fingerprints: FingerprintCache kept by the caller, or None
+        progress: ProgressBus notified while executing, or None
+        rate_limits: RateLimits kept by the caller, or None"""
         self.library = library
         self.config = config
         self.device = device
+        self._fingerprints = fingerprints
+        self.progress = progress
+        self._rate_limits = rate_limits
+        self.report = report or SyncReport()
+        self.report.device = device
+        self._synced_digests = {}  # dirpath -> digest of the playlist
+        self._source_states = {}  # id(track) -> source_state in this sync
+
+    def sync(self, print_plan=True):  # -> SyncReport
+        self.plan(print_plan)
+        return self.execute()
+
+    def plan(self, print_plan=True):  # -> list<SyncPlan>
+        """Plan with the executor stopped, actions run on execute()"""
+        self._executor.report = self.report
+        self._executor.progress = self.progress
+        self._executor.rate_limits = self.rate_limits
+        self._executor.stop()
+        with self.report.phase('planning', profile=True):
+            # Eager evaluation
+            playlist_actions = list(self._sync_playlists())
+        self.report.count_plans(playlist_actions)
+        if print_plan:
+            self.print_plan(playlist_actions)
+        return playlist_actions
+
+    def execute(self):  # -> SyncReport
+        if self.progress is not None:
+            self.progress.start()
+        try:
+            with self.report.phase('execute', profile=True):
+                self._executor.start()
+                self.finish()
+        finally:
+            if self.progress is not None:
+                self.progress.stop()
+        return self.report
+
+    def finish(self):
+        """Wait for submitted actions and save the manifest"""
+        if self.is_dry:
+            self.fingerprints.save()
+            return
+        self.shutdown()
+        if getattr(self.config, 'verify', None):
+            self.verify()
+        self.fingerprints.save()  # With digests of verified sources
+        for dirpath, digest in self._synced_digests.items():
+            if dirpath not in self.report.failed_keys:
+                self.manifest.synced(dirpath, digest)
+        self.manifest.update_mtimes()
+        self.manifest.save()
+        self.manifest.close_journal()
+        self.copy_engine.close()
 
-    def sync(self, print_plan=True):
+    @cached_property
+    def rate_limits(self):
+        rate_limits = self._rate_limits or RateLimits()
+        rate_limits.configure(self.device, self.config)
+        return rate_limits
+
+    def verify(self):
+        """Copy files differing from their sources again"""
+        verifier = SyncVerifier(self.manifest, self.library,
+                                self.fingerprints,
+                                getattr(self.config, 'jobs', 1))
+        targets = None  # All
+        if self.config.verify == VERIFY_SAMPLE:
+            targets = verifier.sample(getattr(
+                self.config, 'verify_sample_ratio', VERIFY_SAMPLE_RATIO))
+        with self.report.phase('verify'):
+            mismatches = verifier.verify(targets)
+        if not mismatches:
+            return
         with ExecutorSuspender(self._executor):
-            playlist_actions = self._sync_playlists()  # Eager evaluation
-            if print_plan:
-                self.print_plan(playlist_actions)
+            for src, dst, entry in mismatches:
+                warn(_i("{} differs from its source, copying it again.")
+                     .format(dst))
+                self.submit(FileCopyAction(
+                    src, dst, self.manifest, entry.get('track_id'),
+                    entry.get('fingerprint'), self.copy_engine))
+        self.shutdown()
+
+    @cached_property
+    def fingerprints(self):
+        if self._fingerprints is not None:
+            return self._fingerprints
+        cache_path = getattr(self.config, 'cache_path', None)
+        if cache_path is None:  # Not kept over syncs
+            return FingerprintCache()
+        return FingerprintCache.load(cache_path(FINGERPRINT_CACHE_FILENAME),
+                                     self.config.use_fingerprint_hash)
+
+    @cached_property
+    def manifest(self):
+        manifest = SyncManifest.load(self.device.manifest_path,
+                                     self.device.root_dir,
+                                     getattr(self.config, 'is_rescan', False))
+        if not self.is_dry:
+            manifest.open_journal()
+        return manifest
 
     def _sync_playlists(self):
-        for playlist in self.target_playlists:
+        """Playlists are planned on a thread pool, and plans are merged in
+        order of target_playlists.  Directories of playlists differ, so
+        actions submitted by planners do not depend on each other."""
+        jobs = getattr(self.config, 'planning_jobs', PLANNING_JOBS)
+        # Shared caches are created once, before planners use them
+        manifest = self.manifest
+        fingerprints = self.fingerprints
+        copy_engine = self.copy_engine
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            if getattr(self.config, 'layout',
+                       LAYOUT_DIRECTORIES) == LAYOUT_POOL:
+                self.resolve_tracks(self.target_playlists, pool)
+                syncer = PoolSyncer(self.target_playlists, self.device,
+                                    manifest, fingerprints, copy_engine)
+                with self.report.phase('plan'):
+                    yield from syncer.sync()
+                return
+            with self.report.phase('check'):
+                digests = list(pool.map(self._planner(self.changed_digest),
+                                        self.target_playlists))
+            playlists = [pl for pl, digest
+                         in zip(self.target_playlists, digests) if digest]
+            self.resolve_tracks(playlists, pool)
+            for plans in pool.map(self._planner(self.plan_playlist),
+                                  playlists, [d for d in digests if d]):
+                yield from plans
+
+    def resolve_tracks(self, playlists, pool):
+        """Find files of tracks in advance, once for tracks shared between
+        playlists"""
+        tracks = {}
+        for playlist in playlists:
+            for track in playlist.tracks:
+                tracks[id(track)] = track
+        with self.report.phase('resolve'):
+            for _ in pool.map(self._planner(self._resolve), tracks.values()):
+                pass
+
+    @staticmethod
+    def _resolve(track):
+        try:
+            track.path
+        except IncompleteLibraryError:
+            pass  # Reported by planning of its playlists
+
+    def _planner(self, f):
+        """f profiled on threads of planners"""
+        profiler = self.report.profiler
+        if profiler is None:
+            return f
+        def profiled(*args):
+            with profiler.thread('planning'):
+                return f(*args)
+        return profiled
+
+    def source_state(self, track):
+        """track.source_state, stat once per sync for shared tracks"""
+        try:
+            return self._source_states[id(track)]
+        except KeyError:
+            state = self._source_states[id(track)] = track.source_state
+            return state
+
+    def changed_digest(self, playlist):  # -> str or None
+        """Digest of playlist, None if it is unchanged since last sync"""
+        digest = playlist.digest(self.source_state)
+        dirpath = self.device.playlist_dirpath(playlist)
+        if self.manifest.is_unchanged(dirpath, digest):
+            info(_i("Playlist {} is not changed since last sync, skipped.")
+                 .format(playlist.name))
+            return None
+        return digest
+
+    def plan_playlist(self, playlist, digest):  # -> list<SyncPlan>
+        with self.report.phase('scan'):
             dst_dir = self.targetdir(playlist)
-            syncer = PlaylistSyncer(playlist, dst_dir)
-            yield from syncer.sync()
+        syncer = PlaylistSyncer(playlist, dst_dir)
+        with self.report.phase('plan'):
+            plans = list(syncer.sync())
+        if not any(isinstance(plan, AnErrorOccurrd) for plan in plans):
+            self._synced_digests[dst_dir.path] = digest
+        return plans
 
     def targetdir(self, playlist):  # -> SyncDirectory
         dirpath = self.device.playlist_dirpath(playlist)
-        return SyncDirectory(dirpath, len(playlist.tracks))
+        return SyncDirectory(dirpath, manifest=self.manifest,
+                             fingerprints=self.fingerprints,
+                             engine=self.copy_engine)
+
+    @cached_property
+    def copy_engine(self):
+        engine = self.device.copy_engine(getattr(self.config, 'fsync', None))
+        engine.progress = self.progress
+        engine.rate_limits = self.rate_limits
+        read_ahead = getattr(self.config, 'read_ahead', 0)
+        if read_ahead:
+            engine.read_ahead = ReadAhead(read_ahead, engine.chunk_size)
+        return engine
 
     @cached_property
     def target_playlists(self):
@@ -1247,11 +4607,203 @@ class LibrarySyncer(WorkerMixin):
 
 
 class DryLibrarySyncer(LibrarySyncer):
+    is_dry = True
+
     def __init__(self, *args, **kw):
         super().__init__(*args, **kw)
         self._inject_executor(DryExecutor())
 
 
+class PlanningSyncer(DryLibrarySyncer):
+    """Plans without touching the device, and saves the plan"""
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self._inject_executor(PlanRecorder())
+
+    def finish(self):
+        super().finish()
+        plan = SyncPlanFile.from_syncer(self, self._executor.actions)
+        plan.save(self.config.plan_out)
+        info(_i("Plan of {} actions was saved to {}")
+             .format(len(plan.actions), self.config.plan_out))
+
+
+class SyncVerifier:
+    """Compares files recorded in a manifest with their sources.
+
+    Both sides are hashed on a thread pool, since hashlib releases the
+    GIL.  Source digests are cached in FingerprintCache, so verifying
+    again only reads the device.  Files whose sources changed since they
+    were copied are left to the next sync.
+    """
+    def __init__(self, manifest, library, fingerprints, jobs=1):
+        self.manifest = manifest
+        self.library = library
+        self.fingerprints = fingerprints
+        self.jobs = max(1, jobs)
+
+    def targets(self):  # -> list<(src, dst, entry)>
+        targets = []
+        for reldir, entries in self.manifest.entries():
+            for name, entry in entries:
+                if entry.get('track_id') is None:
+                    continue
+                try:
+                    src = self.library.track(entry['track_id']).path
+                except KeyError:
+                    continue  # Removed from the library
+                if src is not None:
+                    targets.append((src, self.manifest._join(reldir, name),
+                                    entry))
+        return targets
+
+    def sample(self, ratio):  # -> list<(src, dst, entry)>
+        targets = self.targets()
+        if not targets:
+            return []
+        return random.sample(targets, min(len(targets),
+                                          max(1, int(len(targets) * ratio))))
+
+    def verify(self, targets=None):  # -> list<(src, dst, entry)>
+        """Targets whose files differ from their sources"""
+        if targets is None:
+            targets = self.targets()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.jobs) as pool:
+            results = list(pool.map(self._differs, targets))
+        return [target for target, differs in zip(targets, results)
+                if differs]
+
+    def _differs(self, target):  # -> bool
+        src, dst, entry = target
+        try:
+            if self.fingerprints.fingerprint(src) != entry.get('fingerprint'):
+                return False  # Changed, copied again by the next sync
+            if os.path.getsize(src) != os.path.getsize(dst):
+                return True
+            return self.fingerprints.digest(src) != \
+                file_digest(dst, drop_cache=True)
+        except FileNotFoundError:
+            return os.path.exists(src)
+        except OSError as e:
+            warn(_i("Unable to verify {}: {}").format(dst, e))
+            return False
+
+
+class MultiDeviceSyncer:
+    """Syncs the same playlists to several devices in a run.
+
+    Every device is planned first, then all devices are written at once,
+    each by the executor of its LibrarySyncer.  Sources copied to more
+    than one device are read once, through a FanOutCache shared by copy
+    engines of the devices.
+    """
+    def __init__(self, syncers, fanout=None):
+        self.syncers = syncers
+        self.fanout = fanout or FanOutCache()
+
+    def sync(self, print_plan=True):  # -> list<SyncReport>
+        for syncer in self.syncers:
+            syncer.copy_engine.fanout = self.fanout
+            for plan in syncer.plan(print_plan):
+                if isinstance(plan, WillBeCopied):
+                    self.fanout.expect(plan.track.path, syncer.copy_engine)
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(self.syncers) or 1) as pool:
+            return list(pool.map(self.execute, self.syncers))
+
+    def execute(self, syncer):  # -> SyncReport
+        try:
+            return syncer.execute()
+        finally:
+            # Sources of copies which failed or did not run
+            self.fanout.release(syncer.copy_engine)
+
+
+class RenumberPlanner:
+    """Chooses index numbers of a playlist which need fewest renames.
+
+    Files keeping their numbers are the longest chain whose numbers
+    increase along the playlist and leave enough room for the tracks
+    between them.  Track i (1-based) with number e fits in the chain only
+    after those with e - i not greater than its own, so the chain is the
+    longest non-decreasing subsequence of e - i.  The other tracks get
+    numbers spread over the gaps, which keeps room for later insertions.
+    """
+    STRIDE = 10
+
+    def __init__(self, current):
+        """current: list<(number, digits) or None> in playlist order"""
+        self.current = current
+
+    @property
+    def width(self):  # most common digits of current numbers
+        widths = collections.Counter(c[1] for c in self.current if c)
+        if widths:
+            return widths.most_common(1)[0][0]
+
+    def plan(self):  # -> (list<int>, int)
+        width = self.width
+        if width is not None and len(self.current) <= 10 ** width:
+            anchors = self._anchors(width, 10 ** width)
+            if anchors:
+                return self._fill(anchors, 10 ** width), width
+        return self._renumber()
+
+    def _anchors(self, width, limit):  # -> list<(index, number)>
+        count = len(self.current)
+        tails = []      # smallest last key of chains by their length
+        tail_idx = []
+        prev = {}
+        for index, cur in enumerate(self.current):
+            if cur is None or cur[1] != width:
+                continue
+            key = cur[0] - (index + 1)
+            if not -1 <= key <= limit - 1 - count:
+                continue  # No room for tracks before or after it
+            pos = bisect.bisect_right(tails, key)
+            prev[index] = tail_idx[pos - 1] if pos > 0 else None
+            if pos == len(tails):
+                tails.append(key)
+                tail_idx.append(index)
+            else:
+                tails[pos] = key
+                tail_idx[pos] = index
+        anchors = []
+        index = tail_idx[-1] if tail_idx else None
+        while index is not None:
+            anchors.append((index, self.current[index][0]))
+            index = prev[index]
+        anchors.reverse()
+        return anchors
+
+    def _fill(self, anchors, limit):
+        numbers = [None] * len(self.current)
+        lo_index, lo = -1, -1  # number 0 is the first usable one
+        for index, number in anchors:
+            self._spread(numbers, lo_index + 1, index, lo, number)
+            numbers[index] = number
+            lo_index, lo = index, number
+        rest = len(numbers) - lo_index - 1
+        if lo + rest * self.STRIDE < limit:
+            for i in range(rest):
+                numbers[lo_index + 1 + i] = lo + (i + 1) * self.STRIDE
+        else:
+            self._spread(numbers, lo_index + 1, len(numbers), lo, limit)
+        return numbers
+
+    def _spread(self, numbers, start, end, lo, hi):
+        count = end - start
+        for i in range(count):
+            numbers[start + i] = lo + (hi - lo) * (i + 1) // (count + 1)
+
+    def _renumber(self):
+        count = len(self.current)
+        numbers = [1 + i * self.STRIDE for i in range(count)]
+        width = len(str(numbers[-1])) if numbers else 1
+        return numbers, width
+
+
 class PlaylistSyncer(WorkerMixin):
     def __init__(self, playlist, dst_dir):
         """playlist: Playlist, dst_dir: SyncDirectory"""
@@ -1261,10 +4813,25 @@ class PlaylistSyncer(WorkerMixin):
     def sync(self):
         tracks = self.playlist.tracks
         yield from self.targetdir.prune_tracks(tracks)
-        for index, track in zipwithindex(tracks, start=1):
-            artist = track.get('artist', _i('<No artist>'))
-            title = track.get('name', _i('<No Title>'))
-            yield self.targetdir.update_track_at(track, index)
+        numbers = self.plan_numbers(tracks)
+        plans = [None] * len(tracks)
+        # Files on the device first, to rename before copying into
+        for existing in (True, False):
+            for index, track in enumerate(tracks):
+                if self.targetdir.has_track(track) == existing:
+                    plans[index] = self.targetdir.update_track_at(
+                        track, numbers[index])
+            if existing:
+                self.targetdir.flush_moves()
+        self.targetdir.flush()
+        yield from plans
+
+    def plan_numbers(self, tracks):  # -> list<int>
+        planner = RenumberPlanner(
+            [self.targetdir.current_number(track) for track in tracks])
+        numbers, width = planner.plan()
+        self.targetdir.index_digits = width
+        return numbers
 
 
 # }}}
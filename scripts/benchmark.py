@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Benchmarks isync with a generated large library
+#
+#   $ python3 scripts/benchmark.py --tracks 20000 --playlists 40 -o bench.json
+#
+# Results of each step (library load, planning, cold sync, no-op resync)
+# are written as JSON, so that runs can be compared.
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import plistlib
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import isync
+
+
+class LibraryGenerator:
+    """Generates a plist library and dummy media files.
+
+    Track popularity follows a Zipf-like distribution, so that playlists
+    overlap as real ones do.
+    """
+    TRACKS_PER_ALBUM = 12
+    ALBUMS_PER_ARTIST = 4
+
+    def __init__(self, root, tracks, playlists, playlist_size,
+                 file_size=4096, seed=0):
+        self.root = root
+        self.tracks_count = tracks
+        self.playlists_count = playlists
+        self.playlist_size = playlist_size
+        self.file_size = file_size
+        self.random = random.Random(seed)
+
+    @property
+    def media_dir(self):
+        return os.path.join(self.root, 'iTunes Media', 'Music')
+
+    @property
+    def library_path(self):
+        return os.path.join(self.root, 'iTunes Music Library.xml')
+
+    def generate(self):
+        tracks = dict(self._generate_tracks())
+        playlists = list(self._generate_playlists())
+        with open(self.library_path, 'wb') as f:
+            plistlib.dump({
+                'Major Version': 1,
+                'Minor Version': 1,
+                'Application Version': '10.7',
+                'Music Folder': self._url(self.root),
+                'Tracks': tracks,
+                'Playlists': playlists,
+            }, f)
+        return self.library_path
+
+    def _generate_tracks(self):
+        body = b'\0' * self.file_size
+        modified = datetime.datetime(2012, 1, 1)
+        for index in range(self.tracks_count):
+            album_index = index // self.TRACKS_PER_ALBUM
+            artist = 'Artist {:05d}'.format(
+                album_index // self.ALBUMS_PER_ARTIST)
+            album = 'Album {:06d}'.format(album_index)
+            number = index % self.TRACKS_PER_ALBUM + 1
+            name = 'Tune {:07d}'.format(index)
+            dirpath = os.path.join(self.media_dir, artist, album)
+            os.makedirs(dirpath, exist_ok=True)
+            path = os.path.join(dirpath, '{:02d} {}.mp3'.format(number, name))
+            with open(path, 'wb') as f:
+                f.write(body)
+            track_id = index + 1000
+            yield str(track_id), {
+                'Track ID': track_id,
+                'Name': name,
+                'Artist': artist,
+                'Album': album,
+                'Kind': 'MPEG audio file',
+                'Size': self.file_size,
+                'Total Time': 240000,
+                'Track Number': number,
+                'Date Modified': modified,
+                'Date Added': modified,
+                'Play Count': self.random.randint(0, 100),
+                'Persistent ID': '{:016X}'.format(track_id),
+                'Track Type': 'File',
+                'Location': self._url(path),
+            }
+
+    def _generate_playlists(self):
+        yield {
+            'Name': 'Library',
+            'Master': True,
+            'Playlist ID': 1,
+            'Playlist Persistent ID': '{:016X}'.format(1),
+            'Visible': False,
+            'All Items': True,
+            'Playlist Items': [{'Track ID': i + 1000}
+                               for i in range(self.tracks_count)],
+        }
+        weights = [1.0 / (rank + 1) for rank in range(self.tracks_count)]
+        ids = list(range(1000, 1000 + self.tracks_count))
+        self.random.shuffle(ids)
+        for index in range(self.playlists_count):
+            size = min(self.tracks_count, max(1, int(
+                self.random.gauss(self.playlist_size,
+                                  self.playlist_size / 4))))
+            chosen = set()
+            while len(chosen) < size:
+                chosen.update(self.random.choices(ids, weights,
+                                                  k=size - len(chosen)))
+            items = list(chosen)
+            self.random.shuffle(items)
+            yield {
+                'Name': 'Playlist {:03d}'.format(index),
+                'Playlist ID': index + 2,
+                'Playlist Persistent ID': '{:016X}'.format(index + 2),
+                'All Items': True,
+                'Playlist Items': [{'Track ID': i} for i in items],
+            }
+
+    def _url(self, path):
+        return 'file://' + urllib.parse.quote(path)
+
+
+class Benchmark:
+    def __init__(self, workdir, targetdir, jobs=1, trace_memory=True):
+        self.workdir = workdir
+        self.targetdir = targetdir
+        self.jobs = jobs
+        self.trace_memory = trace_memory
+        self.env = isync.Environment()
+        self.results = {}
+
+    def measure(self, name, f):
+        if self.trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            value = f()
+        finally:
+            seconds = time.perf_counter() - started
+            peak = None
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        result = {'seconds': seconds, 'peak_bytes': peak}
+        if isinstance(value, isync.SyncReport):
+            result['report'] = value.to_dict()
+        self.results[name] = result
+        logging.warning("%-14s %10.3f s", name, seconds)
+        return value
+
+    def config(self, library):
+        dic = {
+            'target_playlists': dict(
+                (pl.name, True) for pl in library.playlists
+                if not pl.get('master', False)),
+            'jobs': self.jobs,
+        }
+        return isync.Config(dic, isync.CommandArguments([]),
+                            os.path.join(self.workdir, 'iSyncConfig.json'))
+
+    def sync(self, library, syncer_class=isync.LibrarySyncer):
+        isync.ExecutorService.root.default = isync.Executor(self.jobs)
+        device = isync.SyncTargetDir(self.targetdir)
+        syncer = syncer_class(library, self.config(library), device)
+        return syncer.sync(print_plan=False)
+
+    def run(self, library_path):
+        cache = isync.LibraryCache(
+            os.path.join(self.workdir, isync.LIBRARY_CACHE_FILENAME))
+        library = self.measure('library_load', lambda: isync.Library(
+            library_path, self.env, cache=cache))
+        self.measure('library_cached', lambda: isync.Library(
+            library_path, self.env, cache=cache))
+        self.measure('planning', lambda: self.sync(
+            library, isync.DryLibrarySyncer))
+        self.measure('cold_sync', lambda: self.sync(library))
+        self.measure('noop_resync', lambda: self.sync(library))
+        return self.results
+
+
+def default_targetroot():
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'  # tmpfs
+    return None
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmarks isync')
+    parser.add_argument('--tracks', type=int, default=10000)
+    parser.add_argument('--playlists', type=int, default=20)
+    parser.add_argument('--playlist-size', type=int, default=500)
+    parser.add_argument('--file-size', type=int, default=4096,
+                        help='Size of each dummy media file in bytes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Do not trace memory, which slows runs down')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep generated files')
+    parser.add_argument('-o', '--output', metavar='PATH',
+                        help='Write results to PATH instead of stdout')
+    opts = parser.parse_args(args)
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+
+    workdir = tempfile.mkdtemp(prefix='isync-bench-')
+    targetdir = tempfile.mkdtemp(prefix='isync-bench-target-',
+                                 dir=default_targetroot())
+    try:
+        generator = LibraryGenerator(
+            workdir, opts.tracks, opts.playlists, opts.playlist_size,
+            opts.file_size, opts.seed)
+        started = time.perf_counter()
+        library_path = generator.generate()
+        logging.warning("%-14s %10.3f s", 'generate',
+                        time.perf_counter() - started)
+        benchmark = Benchmark(workdir, targetdir, opts.jobs,
+                              not opts.no_memory)
+        output = {
+            'params': vars(opts),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'library_bytes': os.path.getsize(library_path),
+            'results': benchmark.run(library_path),
+        }
+    finally:
+        if not opts.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+            shutil.rmtree(targetdir, ignore_errors=True)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(output, f, indent=4)
+    else:
+        json.dump(output, sys.stdout, indent=4)
+        print()
+
+
+if __name__ == '__main__':
+    main()
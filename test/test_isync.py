@@ -6,7 +6,14 @@ import os
 import shutil
 import sys
 import io
+import json
+import collections
+import gc
+import pstats
 import logging
+import threading
+import concurrent.futures
+import time
 
 pjoin = os.path.join
 APPROOT = os.path.abspath(pjoin(os.path.dirname(__file__), '../'))
@@ -67,6 +74,80 @@ class TestLibrary:
         assert_equals(tr.path, os.path.join(TUNESDIR, 'TuneAlpha.mp3'))
         shutil.rmtree(os.path.join(TUNESDIR), 'TuneAlpha.mp3')
 
+    def test_track_record(self):
+        lib = isync.Library(create_library('testlib.xml'))
+        tr = lib.track(1370)
+        ok_(tr is lib.track('1370'))
+        ok_(not hasattr(tr, '__dict__'))
+        assert_equals('TuneDelta', tr.filename)
+        assert_equals(1370, tr.track_id)
+        assert_equals(tr['Size'], tr.size)
+        assert_equals(tr['Total Time'], tr.get('total_time'))
+
+    def test_stream_reader(self):
+        reader = isync.PlistStreamReader(create_library('testlib.xml'))
+        items = list(reader)
+        tracks = [key for kind, key, _ in items if kind == reader.TRACK]
+        playlists = [dic['Name'] for kind, _, dic in items
+                     if kind == reader.PLAYLIST]
+        assert_equals(['1368', '1370'], tracks)
+        assert_equals(['ライブラリ', 'A Playlist'], playlists)
+        assert_equals('10.7', reader.header['Application Version'])
+        ok_(reader.header['Show Content Ratings'])
+
+class TestLibraryCache:
+    def setup(self):
+        remove_test_files()
+        prepare_tunedir()
+        self.libpath = pjoin(TUNESDIR, 'library.xml')
+        with open(self.libpath, 'wb') as f:
+            f.write(create_library('testlib.xml').read())
+        self.cache = isync.LibraryCache(pjoin(TUNESDIR, 'library.cache'))
+
+    def teardown(self):
+        remove_test_files()
+
+    def test_warm_start(self):
+        lib1 = isync.Library(self.libpath, cache=self.cache)
+        ok_(self.cache.load(self.libpath) is not None)
+        lib2 = isync.Library(self.libpath, cache=self.cache)
+        assert_equals(lib1.track(1368).name, lib2.track(1368).name)
+        pl = lib2.playlist_by_name('A Playlist')
+        assert_equals(['TuneDelta'], [tr.name for tr in pl.tracks])
+
+    def test_invalidate(self):
+        isync.Library(self.libpath, cache=self.cache)
+        with open(self.libpath, 'wb') as f:
+            f.write(create_library('testlib2.xml').read())
+        ok_(self.cache.load(self.libpath) is None)
+        lib = isync.Library(self.libpath, cache=self.cache)
+        assert_equals(2, len(lib.playlist_by_name('A Playlist').tracks))
+
+
+class TestMediaIndex:
+    def setup(self):
+        remove_test_files()
+        os.makedirs(pjoin(TUNESDIR, 'Music', 'ArtistEcho', 'AlbumGolf'))
+        touch(TUNESDIR, 'Music', 'ArtistEcho', 'AlbumGolf', '1-02 Tune_ Delta.mp3')
+        self.root = pjoin(TUNESDIR, 'Music')
+        self.path = pjoin(TUNESDIR, 'index.json')
+
+    def teardown(self):
+        remove_test_files()
+
+    def test_find(self):
+        index = isync.MediaIndex.load(self.root, self.path)
+        path = pjoin(self.root, 'ArtistEcho', 'AlbumGolf', '1-02 Tune_ Delta.mp3')
+        assert_equals(path, index.find('ArtistEcho', 'AlbumGolf', 'Tune: Delta'))
+        ok_(index.find('ArtistEcho', 'AlbumGolf', 'TuneFoxtrot') is None)
+        # Persisted index is used without scanning
+        scandir = isync.os.scandir
+        isync.os.scandir = None
+        try:
+            index = isync.MediaIndex.load(self.root, self.path)
+            assert_equals(path, index.find('artistecho', 'albumgolf', 'tune delta'))
+        finally:
+            isync.os.scandir = scandir
 
 
 class TestWindows:
@@ -77,9 +158,7 @@ class TestWindows:
 
 class DummyPlaylists:
     logging_level = logging.DEBUG
-    @property
-    def target_playlists(self):
-        return { 'A Playlist' : True }
+    target_playlists = { 'A Playlist' : True }
 
 class TestLibrarySyncer:
     def setup(self):
@@ -99,6 +178,42 @@ class TestLibrarySyncer:
         syncer.shutdown()
         assert_file_exists(DEVICEDIR, 'MUSIC', 'A Playlist', '1 TuneDelta.mp3')
 
+    def test_report(self):
+        lib = isync.Library(create_library('testlib.xml'))
+        syncer = isync.LibrarySyncer(lib, DummyPlaylists(),
+                                     isync.Walkman(DEVICEDIR))
+        syncer._inject_executor(isync.Executor(max_workers=2))
+        report = syncer.sync()
+        assert_equals({'WillBeCopied': 1}, dict(report.plans))
+        assert_equals(len('DummyFile TuneBravo.mp3'), report.copied_bytes)
+        for phase in ('resolve', 'scan', 'plan', 'planning', 'execute'):
+            ok_(phase in report.phases)
+        assert_equals(1, report.to_dict()['actions']['FileCopyAction'])
+        ok_('TuneDelta' in report.format())
+
+    def test_parallel_planning(self):
+        lib = isync.Library(create_library('testlib.xml'))
+        shared = lib.playlist_by_name('A Playlist').tracks[0]
+        ok_(shared is lib.playlist_by_name('ライブラリ').tracks[1])
+        resolved = []
+        isfile = isync.os.path.isfile
+        def counting_isfile(path):
+            resolved.append(path)
+            return isfile(path)
+        cfg = DummyPlaylists()
+        cfg.target_playlists = {'A Playlist': True, 'ライブラリ': True}
+        cfg.planning_jobs = 2
+        syncer = isync.LibrarySyncer(lib, cfg, isync.Walkman(DEVICEDIR))
+        syncer._inject_executor(ImmediateExecutor())
+        isync.os.path.isfile = counting_isfile
+        try:
+            syncer.sync()
+        finally:
+            isync.os.path.isfile = isfile
+        assert_equals(2, len([p for p in resolved if p.startswith(TUNESDIR)]))
+        assert_file_exists(DEVICEDIR, 'MUSIC', 'A Playlist', '1 TuneDelta.mp3')
+        assert_file_exists(DEVICEDIR, 'MUSIC', 'ライブラリ', '11 TuneDelta.mp3')
+
     def test_update(self):
         lib1 = isync.Library(create_library('testlib.xml'))
         dev1 = isync.Walkman(DEVICEDIR)
@@ -114,8 +229,764 @@ class TestLibrarySyncer:
         syncer2 = isync.LibrarySyncer(lib2, cfg2, dev2)
         syncer2._inject_executor(ImmediateExecutor())
         syncer2.sync()
-        assert_file_exists(DEVICEDIR, 'MUSIC', 'A Playlist', '1 TuneAlpha.mp3')
-        assert_file_exists(DEVICEDIR, 'MUSIC', 'A Playlist', '2 TuneDelta.mp3')
+        # TuneDelta keeps its number
+        assert_file_exists(DEVICEDIR, 'MUSIC', 'A Playlist', '0 TuneAlpha.mp3')
+        assert_file_exists(DEVICEDIR, 'MUSIC', 'A Playlist', '1 TuneDelta.mp3')
+
+
+class TestMultiDeviceSyncer:
+    def setup(self):
+        remove_test_files()
+        prepare_tunedir()
+        prepare_dummy_walkmandir()
+
+    def teardown(self):
+        remove_test_files()
+
+    def test_fan_out(self):
+        lib = isync.Library(create_library('testlib.xml'))
+        syncers = []
+        for name in ('dev1', 'dev2'):
+            device = isync.SyncTargetDir(pjoin(DEVICEDIR, name))
+            syncer = isync.LibrarySyncer(lib, DummyPlaylists(), device)
+            syncer._inject_executor(isync.Executor(max_workers=1))
+            syncers.append(syncer)
+        multi = isync.MultiDeviceSyncer(syncers)
+        reports = multi.sync()
+        assert_equals(1, multi.fanout.hits)
+        for name, report in zip(('dev1', 'dev2'), reports):
+            assert_file_exists(DEVICEDIR, name, 'A Playlist',
+                               '1 TuneDelta.mp3')
+            assert_equals(len('DummyFile TuneBravo.mp3'),
+                          report.copied_bytes)
+
+    def test_cache_limit(self):
+        src = pjoin(TUNESDIR, 'TuneAlpha.mp3')
+        cache = isync.FanOutCache(limit=4)
+        cache.expect(src)
+        cache.expect(src)
+        assert_equals(None, cache.read(src))
+        assert_equals(None, cache.read(src))
+        cache = isync.FanOutCache()
+        cache.expect(src)
+        cache.expect(src)
+        assert_equals(cache.read(src), cache.read(src))
+        assert_equals({}, cache._data)
+
+    def test_cache_release(self):
+        src = pjoin(TUNESDIR, 'TuneAlpha.mp3')
+        cache = isync.FanOutCache()
+        cache.expect(src, 'dev1')
+        cache.expect(src, 'dev2')
+        ok_(cache.read(src, 'dev1'))
+        assert_equals(None, cache.read(src, 'dev1'))  # Not expected again
+        ok_(cache._data)
+        cache.release('dev2')  # Its copy failed
+        assert_equals({}, cache._data)
+        assert_equals(0, cache._bytes)
+        cache.release('dev1')
+        assert_equals({}, dict(cache._wanted))
+
+
+class PlanOutPlaylists(DummyPlaylists):
+    def __init__(self, plan_out):
+        self.plan_out = plan_out
+
+
+class TestSyncPlanFile:
+    def setup(self):
+        remove_test_files()
+        prepare_tunedir()
+        prepare_dummy_walkmandir()
+        self.plan_path = pjoin(TUNESDIR, 'plan.json')
+        lib = isync.Library(create_library('testlib.xml'))
+        isync.PlanningSyncer(lib, PlanOutPlaylists(self.plan_path),
+                             isync.Walkman(DEVICEDIR)).sync()
+
+    def teardown(self):
+        remove_test_files()
+
+    def test_apply(self):
+        ok_(not os.path.exists(pjoin(DEVICEDIR, 'MUSIC')))  # Untouched
+        plan = isync.SyncPlanFile.load(self.plan_path)
+        assert_equals(['copy', 'flush'], [a['op'] for a in plan.actions])
+        assert_equals([], plan.conflicts())
+        report = plan.apply(isync.Executor(max_workers=2))
+        assert_equals(1, report.actions['FileCopyAction'])
+        assert_file_exists(DEVICEDIR, 'MUSIC', 'A Playlist', '1 TuneDelta.mp3')
+        lib = isync.Library(create_library('testlib.xml'))
+        syncer = isync.LibrarySyncer(lib, DummyPlaylists(),
+                                     isync.Walkman(DEVICEDIR))
+        syncer._inject_executor(ImmediateExecutor())
+        assert_equals({}, dict(syncer.sync().plans))  # Digest was recorded
+
+    def test_conflict(self):
+        touch(TUNESDIR, 'TuneBravo.mp3', body='Changed')
+        plan = isync.SyncPlanFile.load(self.plan_path)
+        assert_equals(1, len(plan.conflicts()))
+
+
+class DaemonConfig(DummyPlaylists):
+    jobs = 1
+    engine = 'threads'
+    is_dry = False
+    use_fingerprint_hash = True
+
+    def __init__(self, path):
+        self.path = path
+
+    def cache_path(self, filename):
+        return pjoin(TUNESDIR, filename)
+
+
+class DaemonMain:
+    def __init__(self, libpath):
+        self.libpath = libpath
+        self.config = DaemonConfig(pjoin(TUNESDIR, 'config.json'))
+        self.env = self
+        self.loaded = 0
+
+    def itunes_libfile(self):
+        return self.libpath
+
+    def load_config(self):
+        return self.config
+
+    def load_library(self):
+        self.loaded += 1
+        return isync.Library(self.libpath)
+
+    def find_devices(self):
+        return [isync.Walkman(DEVICEDIR)]
+
+    create_syncer = isync.Main.create_syncer
+    create_library_syncer = isync.Main.create_library_syncer
+    create_executor = isync.Main.create_executor
+    run_syncer = isync.Main.run_syncer
+
+
+class TestSyncDaemon:
+    def setup(self):
+        remove_test_files()
+        prepare_tunedir()
+        prepare_dummy_walkmandir()
+        self.libpath = pjoin(TUNESDIR, 'library.xml')
+        with open(self.libpath, 'wb') as f:
+            f.write(create_library('testlib.xml').read())
+        self.main = DaemonMain(self.libpath)
+        self.socket_path = pjoin(TUNESDIR, 'isync.sock')
+
+    def teardown(self):
+        remove_test_files()
+
+    def test_refresh(self):
+        daemon = isync.SyncDaemon(self.main, self.socket_path)
+        ok_(daemon.refresh())
+        ok_(not daemon.refresh())
+        os.utime(self.libpath, ns=(0, 0))
+        ok_(daemon.refresh())
+        assert_equals(2, self.main.loaded)
+
+    def test_request(self):
+        daemon = isync.SyncDaemon(self.main, self.socket_path,
+                                  poll_interval=60)
+        server = threading.Thread(target=daemon.serve_forever)
+        server.start()
+        try:
+            for _ in range(100):
+                if os.path.exists(self.socket_path):
+                    break
+                time.sleep(0.01)
+            output = io.StringIO()
+            ok_(isync.SyncDaemon.request(self.socket_path, 'sync', output))
+            assert_file_exists(DEVICEDIR, 'MUSIC', 'A Playlist',
+                               '1 TuneDelta.mp3')
+            ok_(not isync.SyncDaemon.request(self.socket_path, 'foo'))
+            ok_(isync.SyncDaemon.request(self.socket_path, 'limit write=5'))
+            assert_equals(5000000, daemon.rate_limits.write.rate)
+        finally:
+            isync.SyncDaemon.request(self.socket_path, 'stop')
+            server.join()
+        assert_equals(1, self.main.loaded)
+        ok_(not os.path.exists(self.socket_path))
+
+    def test_sync_logs(self):
+        daemon = isync.SyncDaemon(self.main, self.socket_path)
+        def request(command, wfile):
+            daemon.handle(io.BytesIO(command.encode('utf-8')), wfile)
+        def run_syncer(*args):
+            worker = threading.Thread(target=isync.warn, args=('worker',))
+            worker.start()
+            worker.join()
+            other = threading.Thread(target=request,
+                                     args=('limit disk=5\n', io.BytesIO()))
+            other.start()
+            other.join()
+        self.main.run_syncer = run_syncer
+        wfile = io.BytesIO()
+        request('sync\n', wfile)
+        assert_equals(['WARNING worker', 'OK'],
+                      wfile.getvalue().decode('utf-8').splitlines())
+
+
+class TestRateLimits:
+    def test_rate(self):
+        bucket = isync.TokenBucket(1000)
+        started = time.monotonic()
+        bucket.acquire(1000)  # Burst
+        bucket.acquire(100)
+        ok_(0.08 < time.monotonic() - started < 0.5)
+
+    def test_change_rate(self):
+        bucket = isync.TokenBucket(1)
+        waiter = threading.Thread(target=bucket.acquire, args=(100,))
+        waiter.start()
+        time.sleep(0.05)
+        bucket.rate = None
+        waiter.join(1)
+        ok_(not waiter.is_alive())
+
+    def test_parse(self):
+        assert_equals({'write': 5.0, 'ops': None},
+                      isync.RateLimits.parse(['write=5', 'ops=off']))
+        assert_raises(ValueError, isync.RateLimits.parse, ['disk=5'])
+
+    def test_non_positive(self):
+        for item in ('write=-5', 'write=0', 'ops=nan', 'read=fast'):
+            assert_raises(ValueError, isync.RateLimits.parse, [item])
+        assert_raises(ValueError, isync.RateLimits().override, write=-5)
+        assert_raises(SystemExit, isync.CommandArguments,
+                      ['--limit-write', '-5'])
+        assert_equals(5.0, isync.CommandArguments(
+            ['--limit-write', '5']).limit_write)
+        assert_raises(ValueError, isync.Config(
+            {'rate_limits': {'default': {'write': 0}}},
+            isync.CommandArguments([])).validate)
+
+
+class RecordingAction(isync.Action):
+    def __init__(self, name, log, key='dir', is_barrier=False, wait=0):
+        self.name = name
+        self.log = log
+        self.ordering_key = key
+        self.is_barrier = is_barrier
+        self.wait = wait
+
+    def run(self):
+        self.log.append(('start', self.name))
+        time.sleep(self.wait)
+        self.log.append(('end', self.name))
+
+
+class TestExecutor:
+    executor_class = isync.Executor
+
+    def test_barrier_ordering(self):
+        log = []
+        executor = self.executor_class(max_workers=4)
+        with isync.ExecutorSuspender(executor):
+            executor.submit(RecordingAction('remove', log, is_barrier=True,
+                                            wait=0.05))
+            executor.submit(RecordingAction('copy1', log, wait=0.05))
+            executor.submit(RecordingAction('copy2', log, wait=0.05))
+            executor.submit(RecordingAction('other', log, key='other'))
+            executor.submit(RecordingAction('rename', log, is_barrier=True))
+        executor.shutdown()
+        index = log.index
+        ok_(index(('end', 'remove')) < index(('start', 'copy1')))
+        ok_(index(('end', 'remove')) < index(('start', 'copy2')))
+        # Copies into same directory run concurrently
+        ok_(index(('start', 'copy2')) < index(('end', 'copy1')))
+        ok_(index(('start', 'other')) < index(('end', 'remove')))
+        ok_(index(('end', 'copy1')) < index(('start', 'rename')))
+        ok_(index(('end', 'copy2')) < index(('start', 'rename')))
+
+    def test_locality_order(self):
+        log = []
+        executor = self.executor_class(max_workers=1, locality=True)
+        actions = [
+            RecordingAction('copy1', log),
+            RecordingAction('copy2', log),
+            RecordingAction('rename', log, is_barrier=True),
+            RecordingAction('copy3', log),
+            RecordingAction('copy4', log),
+        ]
+        for action, locality in zip(actions, (3, 1, None, 2, 0)):
+            action.locality_key = (locality,)
+            action.is_bulk = True  # Serial on AsyncExecutor as well
+        with isync.ExecutorSuspender(executor):
+            for action in actions:
+                executor.submit(action)
+        executor.shutdown()
+        eq_(['copy2', 'copy1', 'rename', 'copy4', 'copy3'],
+            [name for event, name in log if event == 'start'])
+
+
+class TestAsyncExecutor(TestExecutor):
+    executor_class = isync.AsyncExecutor
+
+    def test_bulk_limit(self):
+        log = []
+        executor = isync.AsyncExecutor(max_workers=1)
+        for name in ('copy1', 'copy2'):
+            action = RecordingAction(name, log, key=name, wait=0.05)
+            action.is_bulk = True
+            executor.submit(action)
+        executor.submit(RecordingAction('mkdir', log, key='other'))
+        executor.shutdown()
+        index = log.index
+        ok_(index(('end', 'copy1')) < index(('start', 'copy2')))
+        ok_(index(('start', 'mkdir')) < index(('end', 'copy1')))
+
+    def test_stop_unstarted(self):
+        executor = isync.AsyncExecutor()
+        with isync.ExecutorSuspender(executor):
+            ok_(not hasattr(executor, '_worker'))
+        executor.shutdown()
+        ok_(not hasattr(executor, '_worker'))
+
+
+class TestDryExecutor:
+    def test_report(self):
+        log = []
+        executor = isync.DryExecutor()
+        executor.report = isync.SyncReport()
+        executor.submit(RecordingAction('copy', log))
+        executor.shutdown()
+        assert_equals([], log)
+        assert_equals({'RecordingAction': 1}, dict(executor.report.actions))
+
+
+class RescanPlaylists(DummyPlaylists):
+    is_rescan = True
+
+
+class VerifyPlaylists(DummyPlaylists):
+    verify = isync.VERIFY_FULL
+    use_fingerprint_hash = True
+
+    def cache_path(self, filename):
+        return pjoin(TUNESDIR, filename)
+
+
+class TestSyncManifest:
+    def setup(self):
+        remove_test_files()
+        prepare_tunedir()
+        prepare_dummy_walkmandir()
+        self.listdir = os.listdir
+
+    def teardown(self):
+        isync.os.listdir = self.listdir
+        remove_test_files()
+
+    def sync(self, libname, cfg=None):
+        lib = isync.Library(create_library(libname))
+        syncer = isync.LibrarySyncer(lib, cfg or DummyPlaylists(),
+                                     isync.Walkman(DEVICEDIR))
+        syncer._inject_executor(ImmediateExecutor())
+        syncer.sync()
+        return syncer
+
+    def test_record(self):
+        syncer = self.sync('testlib.xml')
+        manifest = isync.SyncManifest.load(syncer.device.manifest_path,
+                                           DEVICEDIR)
+        path = pjoin(DEVICEDIR, 'MUSIC', 'A Playlist', '1 TuneDelta.mp3')
+        entry = manifest.entry(path)
+        assert_equals(1370, entry['track_id'])
+        assert_equals(os.path.getsize(path), entry['size'])
+
+    def test_plan_without_scan(self):
+        self.sync('testlib.xml')
+        def listdir(path):
+            raise AssertionError("{} was scanned".format(path))
+        isync.os.listdir = listdir
+        self.sync('testlib2.xml')
+        assert_file_exists(DEVICEDIR, 'MUSIC', 'A Playlist', '0 TuneAlpha.mp3')
+        assert_file_exists(DEVICEDIR, 'MUSIC', 'A Playlist', '1 TuneDelta.mp3')
+
+    def test_rescan(self):
+        self.sync('testlib.xml')
+        scanned = []
+        def listdir(path):
+            scanned.append(path)
+            return self.listdir(path)
+        isync.os.listdir = listdir
+        self.sync('testlib.xml', RescanPlaylists())
+        assert_equals([pjoin(DEVICEDIR, 'MUSIC', 'A Playlist')], scanned)
+
+    def test_verify(self):
+        self.sync('testlib.xml')
+        src = pjoin(TUNESDIR, 'TuneBravo.mp3')
+        dst = pjoin(DEVICEDIR, 'MUSIC', 'A Playlist', '1 TuneDelta.mp3')
+        with open(dst, 'r+b') as f:
+            body = f.read()
+            f.seek(0)
+            f.write(bytes(len(body)))  # Corrupted in place
+        self.sync('testlib.xml', VerifyPlaylists())
+        with open(src, 'rb') as f1, open(dst, 'rb') as f2:
+            assert_equals(f1.read(), f2.read())
+
+    def test_track_without_location(self):
+        body = create_library('testlib.xml').read().decode('utf-8')
+        body = body.replace(
+            '<key>Location</key><string>file://{}/TuneBravo.mp3</string>'
+            .format(TUNESDIR), '')
+        lib = isync.Library(io.BytesIO(body.encode('utf-8')))
+        syncer = isync.LibrarySyncer(lib, DummyPlaylists(),
+                                     isync.Walkman(DEVICEDIR))
+        syncer._inject_executor(ImmediateExecutor())
+        plans = syncer.plan(print_plan=False)
+        ok_(any(isinstance(plan, isync.AnErrorOccurrd) for plan in plans))
+
+    def test_verify_caches_digests(self):
+        self.sync('testlib.xml', VerifyPlaylists())
+        path = pjoin(TUNESDIR, isync.FINGERPRINT_CACHE_FILENAME)
+        with open(path, encoding='utf-8') as f:
+            digests = json.load(f)['digests']
+        ok_(pjoin(TUNESDIR, 'TuneBravo.mp3') in digests)
+
+    def test_change_detection(self):
+        self.sync('testlib.xml')
+        src = pjoin(TUNESDIR, 'TuneBravo.mp3')
+        dst = pjoin(DEVICEDIR, 'MUSIC', 'A Playlist', '1 TuneDelta.mp3')
+        os.utime(src, (0, 0))  # Metadata only change
+        def listdir(path):
+            raise AssertionError("{} was scanned".format(path))
+        isync.os.listdir = listdir
+        copied = []
+        copy = isync.FileCopyAction.run
+        isync.FileCopyAction.run = lambda action: copied.append(action.dst)
+        try:
+            self.sync('testlib.xml')
+        finally:
+            isync.FileCopyAction.run = copy
+        assert_equals([], copied)
+        touch(TUNESDIR, 'TuneBravo.mp3', body='DummyFile TuneEcho.mp3')
+        self.sync('testlib.xml')
+        with open(dst) as f:
+            assert_equals('DummyFile TuneEcho.mp3', f.read())
+
+    def test_skip_unchanged(self):
+        self.sync('testlib.xml')
+        report = self.sync('testlib.xml').report
+        assert_equals({}, dict(report.plans))
+        ok_('scan' not in report.phases)
+        touch(DEVICEDIR, 'MUSIC', 'A Playlist', 'foreign.txt')
+        report = self.sync('testlib.xml').report
+        assert_equals({'NothingToDo': 1}, dict(report.plans))
+        report = self.sync('testlib2.xml').report
+        assert_equals(2, sum(report.plans.values()))
+
+    def test_skip_unchanged_sources(self):
+        self.sync('testlib.xml')
+        touch(TUNESDIR, 'TuneBravo.mp3', body='DummyFile TuneEcho.mp3')
+        report = self.sync('testlib.xml').report
+        assert_equals(1, sum(report.plans.values()))  # Not recorded by iTunes
+        report = self.sync('testlib.xml').report
+        assert_equals({}, dict(report.plans))
+
+    def test_removed_on_device(self):
+        self.sync('testlib.xml')
+        dst = pjoin(DEVICEDIR, 'MUSIC', 'A Playlist', '1 TuneDelta.mp3')
+        os.remove(dst)
+        report = self.sync('testlib.xml').report
+        ok_('scan' in report.phases)
+        assert_file_exists(dst)
+        report = self.sync('testlib.xml').report
+        assert_equals({}, dict(report.plans))
+
+    def test_skip_unchanged_same_library(self):
+        lib = isync.Library(create_library('testlib.xml'))
+        def sync():
+            syncer = isync.LibrarySyncer(lib, DummyPlaylists(),
+                                         isync.Walkman(DEVICEDIR))
+            syncer._inject_executor(ImmediateExecutor())
+            syncer.sync()
+        sync()
+        touch(TUNESDIR, 'TuneBravo.mp3', body='DummyFile TuneEcho.mp3')
+        sync()  # As the daemon does
+        dst = pjoin(DEVICEDIR, 'MUSIC', 'A Playlist', '1 TuneDelta.mp3')
+        with open(dst) as f:
+            assert_equals('DummyFile TuneEcho.mp3', f.read())
+
+    def test_resume_interrupted(self):
+        save = isync.SyncManifest.save
+        close_journal = isync.SyncManifest.close_journal
+        isync.SyncManifest.save = isync.SyncManifest.close_journal = \
+            lambda manifest: None  # Unplugged before saving
+        try:
+            syncer = self.sync('testlib.xml')
+        finally:
+            isync.SyncManifest.save = save
+            isync.SyncManifest.close_journal = close_journal
+        journal_path = syncer.manifest.journal_path
+        ok_(os.path.exists(journal_path))
+        def listdir(path):
+            raise AssertionError("{} was scanned".format(path))
+        isync.os.listdir = listdir
+        report = self.sync('testlib.xml').report
+        assert_equals({'NothingToDo': 1}, dict(report.plans))
+        ok_(not os.path.exists(journal_path))
+
+    def test_unfinished_rename(self):
+        self.sync('testlib.xml')
+        dirpath = pjoin(DEVICEDIR, 'MUSIC', 'A Playlist')
+        os.rename(pjoin(dirpath, '1 TuneDelta.mp3'),
+                  pjoin(dirpath, '.isync-tmp 1 TuneDelta.mp3'))
+        self.sync('testlib.xml', RescanPlaylists())
+        assert_equals(['1 TuneDelta.mp3'], sorted(os.listdir(dirpath)))
+
+
+class PoolPlaylists(DummyPlaylists):
+    layout = 'pool'
+
+    def __init__(self, playlists):
+        self.playlists = playlists
+
+    @property
+    def target_playlists(self):
+        return dict((name, True) for name in self.playlists)
+
+
+class TestPoolSyncer:
+    def setup(self):
+        remove_test_files()
+        prepare_tunedir()
+        os.mkdir(DEVICEDIR)
+
+    def teardown(self):
+        remove_test_files()
+
+    def sync(self, *playlists):
+        lib = isync.Library(create_library('testlib.xml'))
+        syncer = isync.LibrarySyncer(lib, PoolPlaylists(playlists),
+                                     isync.SyncTargetDir(DEVICEDIR))
+        syncer._inject_executor(ImmediateExecutor())
+        syncer.sync()
+
+    def test_shared_tracks(self):
+        self.sync('A Playlist', 'ライブラリ')
+        pooldir = pjoin(DEVICEDIR, 'iSyncPool')
+        assert_equals(2, len(os.listdir(pooldir)))
+        with open(pjoin(DEVICEDIR, 'A Playlist.m3u8'), encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        assert_equals('#EXTM3U', lines[0])
+        ok_(lines[1].startswith('#EXTINF:247,ArtistEcho - TuneDelta'))
+        assert_file_exists(DEVICEDIR, lines[2])
+        assert_file_exists(DEVICEDIR, 'ライブラリ.m3u8')
+
+    def test_prune(self):
+        self.sync('A Playlist', 'ライブラリ')
+        self.sync('A Playlist')
+        assert_equals(1, len(os.listdir(pjoin(DEVICEDIR, 'iSyncPool'))))
+        ok_(not os.path.exists(pjoin(DEVICEDIR, 'ライブラリ.m3u8')))
+
+    def test_unmounted_source(self):
+        self.sync('A Playlist', 'ライブラリ')
+        playlist = pjoin(DEVICEDIR, 'A Playlist.m3u8')
+        with open(playlist, encoding='utf-8') as f:
+            text = f.read()
+        shutil.rmtree(TUNESDIR)
+        self.sync('A Playlist', 'ライブラリ')
+        assert_equals(2, len(os.listdir(pjoin(DEVICEDIR, 'iSyncPool'))))
+        with open(playlist, encoding='utf-8') as f:
+            assert_equals(text, f.read())
+
+
+class TestCopyEngine:
+    def setup(self):
+        remove_test_files()
+        prepare_tunedir()
+        self.src = pjoin(TUNESDIR, 'large.mp3')
+        touch(self.src, body='0123456789' * 100000)
+
+    def teardown(self):
+        remove_test_files()
+
+    def test_strategies(self):
+        for name in isync.CopyEngine.STRATEGIES:
+            dst = pjoin(TUNESDIR, name + '.mp3')
+            engine = isync.CopyEngine([name, 'readinto'], chunk_size=4096)
+            assert_equals(1000000, engine.copy(self.src, dst))
+            with open(self.src) as f1, open(dst) as f2:
+                assert_equals(f1.read(), f2.read())
+
+    def test_batched_fsync(self):
+        synced = []
+        fsync = isync.os.fsync
+        isync.os.fsync = lambda fd: synced.append(fd)
+        try:
+            engine = isync.CopyEngine(fsync_policy=isync.FSYNC_PLAYLIST)
+            engine.copy(self.src, pjoin(TUNESDIR, 'a.mp3'))
+            engine.copy(self.src, pjoin(TUNESDIR, 'b.mp3'))
+            assert_equals([], synced)
+            engine.flush(TUNESDIR)
+            assert_equals(3, len(synced))  # Two files and the directory
+            engine.flush(TUNESDIR)
+            assert_equals(3, len(synced))
+        finally:
+            isync.os.fsync = fsync
+
+    def test_file_fsync(self):
+        synced = []
+        fsync = isync.os.fsync
+        isync.os.fsync = lambda fd: synced.append(fd)
+        try:
+            engine = isync.CopyEngine(fsync_policy=isync.FSYNC_FILE)
+            engine.copy(self.src, pjoin(TUNESDIR, 'a.mp3'))
+            assert_equals(2, len(synced))  # The file and the directory
+            engine.flush(TUNESDIR)
+            assert_equals(2, len(synced))
+        finally:
+            isync.os.fsync = fsync
+
+    def test_no_fsync(self):
+        synced = []
+        fsync = isync.os.fsync
+        isync.os.fsync = lambda fd: synced.append(fd)
+        try:
+            checkpoints = []
+            engine = isync.CopyEngine(fsync_policy=isync.FSYNC_NONE)
+            engine.CHECKPOINT_BYTES = 300000
+            engine.copy(self.src, pjoin(TUNESDIR, 'a.mp3'),
+                        checkpoint=checkpoints.append)
+            engine.flush(TUNESDIR)
+            assert_equals([], synced)
+            assert_equals([], checkpoints)
+        finally:
+            isync.os.fsync = fsync
+
+    def test_resume(self):
+        dst = pjoin(TUNESDIR, 'dst.mp3')
+        part = isync.CopyEngine.part_path(dst)
+        touch(part, body='0123456789' * 4000 + 'garbage')
+        checkpoints = []
+        engine = isync.CopyEngine(fsync_policy=isync.FSYNC_PLAYLIST)
+        engine.CHECKPOINT_BYTES = 300000
+        assert_equals(960000, engine.copy(self.src, dst, resume=40000,
+                                          checkpoint=checkpoints.append))
+        assert_equals([340000, 640000, 940000], checkpoints)
+        ok_(not os.path.exists(part))
+        with open(self.src) as f1, open(dst) as f2:
+            assert_equals(f1.read(), f2.read())
+
+    def test_read_ahead(self):
+        engine = isync.CopyEngine(chunk_size=4096)
+        engine.read_ahead = isync.ReadAhead(4 * 4096, 4096)
+        srcs = []
+        for i in range(3):
+            src = pjoin(TUNESDIR, 'src{}.mp3'.format(i))
+            touch(src, body=str(i) * 50000)
+            srcs.append(src)
+            engine.prefetch(src)
+        engine.prefetch(self.src)  # Never copied
+        for src in srcs:
+            dst = src + '.copy'
+            assert_equals(50000, engine.copy(src, dst))
+            with open(src) as f1, open(dst) as f2:
+                assert_equals(f1.read(), f2.read())
+        engine.close()
+        read_ahead = engine.read_ahead
+        ok_(read_ahead._allocated <= 4)
+        assert_equals(read_ahead._allocated, len(read_ahead._free))
+
+    def test_read_ahead_larger_than_pool(self):
+        engine = isync.CopyEngine(chunk_size=4096,
+                                  fsync_policy=isync.FSYNC_NONE)
+        engine.read_ahead = isync.ReadAhead(2 * 4096, 4096)
+        srcs = []
+        for i in range(40):
+            src = pjoin(TUNESDIR, 'src{}.mp3'.format(i))
+            touch(src, body=''.join(chr(48 + (i + n) % 64)
+                                    for n in range(20000 + i * 1000)))
+            srcs.append(src)
+            engine.prefetch(src)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(lambda src: engine.copy(src, src + '.copy'), srcs))
+        engine.close()
+        for src in srcs:
+            with open(src) as f1, open(src + '.copy') as f2:
+                assert_equals(f1.read(), f2.read())
+
+    def test_buffered_then_kernel_copy(self):
+        dst = pjoin(TUNESDIR, 'dst.mp3')
+        with open(self.src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fdst.write(fsrc.read(4096))  # Left in the buffer of fdst
+            for name in ('copy_file_range', 'sendfile'):
+                try:
+                    isync.CopyEngine.STRATEGIES[name].transfer(
+                        fsrc, fdst, 1000000 - 4096, 65536)
+                    break
+                except isync.CopyStrategyUnavailable:
+                    continue
+            else:
+                return
+        with open(self.src) as f1, open(dst) as f2:
+            assert_equals(f1.read(), f2.read())
+
+
+class TestRenumberPlanner:
+    def plan(self, current, width=3):
+        return isync.RenumberPlanner(
+            [(n, width) if n is not None else None for n in current]).plan()
+
+    def test_fresh(self):
+        assert_equals(([1, 11, 21], 2), self.plan([None, None, None]))
+
+    def test_insert_at_top(self):
+        numbers, width = self.plan([None] + list(range(1, 100)), width=2)
+        assert_equals(2, width)
+        assert_equals(list(range(0, 100)), numbers)
+
+    def test_move_one(self):
+        current = list(range(10, 20010, 10))
+        current.insert(10, current.pop(1500))
+        numbers, width = self.plan(current, width=5)
+        changed = [n for n, c in zip(numbers, current) if n != c]
+        assert_equals(1, len(changed))
+        assert_equals(sorted(numbers), numbers)
+
+    def test_append(self):
+        numbers, width = self.plan([1, 11, 21, None, None])
+        assert_equals([1, 11, 21, 31, 41], numbers)
+
+    def test_overflow(self):
+        numbers, width = self.plan([1, 2, 3, 4, 5, 6, 7, 8, 9, None], width=1)
+        assert_equals(2, width)
+        assert_equals(sorted(numbers), numbers)
+
+
+class TestFlushMoves:
+    def setup(self):
+        remove_test_files()
+        prepare_dummy_walkmandir()
+        self.dirpath = pjoin(DEVICEDIR, 'MUSIC')
+        os.makedirs(self.dirpath)
+        touch(self.dirpath, '1 Foo.mp3', body='1')
+        touch(self.dirpath, '2 Foo.mp3', body='2')
+
+    def teardown(self):
+        remove_test_files()
+
+    def test_swap(self):
+        syncdir = isync.SyncDirectory(self.dirpath)
+        syncdir._inject_executor(ImmediateExecutor())
+        syncdir._moves = [('1 Foo.mp3', '2 Foo.mp3'),
+                          ('2 Foo.mp3', '1 Foo.mp3')]
+        syncdir.flush_moves()
+        with open(pjoin(self.dirpath, '1 Foo.mp3')) as f:
+            assert_equals('2', f.read())
+        with open(pjoin(self.dirpath, '2 Foo.mp3')) as f:
+            assert_equals('1', f.read())
+
+    def test_empty_playlist(self):
+        syncdir = isync.SyncDirectory(self.dirpath)
+        syncdir._inject_executor(ImmediateExecutor())
+        playlist = collections.namedtuple('Playlist', 'tracks')([])
+        plans = list(isync.PlaylistSyncer(playlist, syncdir).sync())
+        ok_(all(isinstance(plan, isync.WillBeDeleted) for plan in plans))
 
 
 class DummyWorker(isync.WorkerMixin):
@@ -147,12 +1018,45 @@ class TestWorker:
         worker = plane_class.create_worker()
         assert_equals(100, worker._executor)
 
+class TestConfig:
+    def setup(self):
+        remove_test_files()
+        prepare_tunedir()
+
+    def teardown(self):
+        remove_test_files()
+
+    def test_invalid_choices(self):
+        for key in ('engine', 'layout', 'copy_order'):
+            assert_raises(ValueError, isync.Config(
+                {key: 'foo'}, isync.CommandArguments([])).validate)
+        isync.Config({'engine': 'async', 'layout': isync.LAYOUT_POOL},
+                     isync.CommandArguments([])).validate()
+
+    def test_invalid_fsync(self):
+        path = pjoin(TUNESDIR, 'config.json')
+        with open(path, 'w') as f:
+            json.dump({'fsync': 'always'}, f)
+        assert_raises(ValueError, isync.Config.load,
+                      isync.CommandArguments([]), path)
+        with open(path, 'w') as f:
+            json.dump({'fsync': isync.FSYNC_FILE}, f)
+        assert_equals(isync.FSYNC_FILE, isync.Config.load(
+            isync.CommandArguments([]), path).fsync)
+
+
 class TestCommandArguments:
     def test_parse(self):
         opts = isync.CommandArguments('--logging INFO -d'.split())
         ok_(opts.dry)
         assert_equals(opts.logging, 'INFO')
 
+    def test_jobs(self):
+        opts = isync.CommandArguments(['-j', '4'])
+        cfg = isync.Config({}, opts)
+        assert_equals(4, cfg.jobs)
+        assert_equals(1, isync.Config({}, isync.CommandArguments([])).jobs)
+
     def test_interface(self):
         opts = isync.CommandArguments(['-v'])
         ok_('verbose' in opts)
@@ -177,9 +1081,78 @@ class TestEvent:
         target.fire(20)
         assert_equals(10, self.last_arg) # not called
 
+    def test_weak_targets(self):
+        target = EventHolder()
+        target.on_foobar += self.handler_mock
+        eq_(1, len(EventHolder.on_foobar._objects))
+        del target
+        gc.collect()
+        eq_(0, len(EventHolder.on_foobar._objects))
+
     def handler_mock(self, arg):
         self.last_arg = arg
 
+
+class TestProgressBus:
+    def setup(self):
+        self.snapshots = []
+
+    def subscriber(self, progress):
+        self.snapshots.append(progress)
+
+    def test_executor_progress(self):
+        bus = isync.ProgressBus(interval=60)
+        bus.subscribe(self.subscriber)
+        executor = isync.Executor(max_workers=2)
+        executor.progress = bus
+        bus.start()
+        with isync.ExecutorSuspender(executor):
+            for name in ('a', 'b', 'c'):
+                executor.submit(RecordingAction(name, [], key=name))
+        executor.shutdown()
+        bus.stop()
+        # Coalesced into the final snapshot
+        eq_(1, len(self.snapshots))
+        eq_((3, 3), self.snapshots[0][:2])
+
+    def test_weak_subscribers(self):
+        bus = isync.ProgressBus()
+        holder = TestProgressBus()
+        holder.setup()
+        bus.subscribe(holder.subscriber)
+        bus.subscribe(self.subscriber)
+        del holder
+        gc.collect()
+        bus.copied(100)
+        bus.dispatch()
+        eq_(100, self.snapshots[0].bytes_done)
+        eq_(1, len(bus._subscribers))
+
+class TestPhaseProfiler:
+    def setup(self):
+        remove_test_files()
+        prepare_tunedir()
+        self.dirpath = pjoin(TUNESDIR, 'profile')
+
+    def teardown(self):
+        remove_test_files()
+
+    def test_execute(self):
+        report = isync.SyncReport()
+        report.profiler = isync.PhaseProfiler(self.dirpath, memory=True)
+        executor = isync.Executor(max_workers=2)
+        executor.report = report
+        with report.phase('execute', profile=True):
+            for name in ('a', 'b'):
+                executor.submit(RecordingAction(name, [], key=name))
+            executor.shutdown()
+        stats = pstats.Stats(pjoin(self.dirpath, 'execute.pstats'))
+        ok_(any(func[2] == 'run' and 'test_isync' in func[0]
+                for func in stats.stats))
+        ok_(os.path.exists(pjoin(self.dirpath, 'execute-memory.txt')))
+        ok_('execute' in report.phases)
+
+
 class TestActualFile:
     def test_filenameparse(self):
         af = isync.ActualFile('/Foobar/012 HogeHoge.mp3')